@@ -0,0 +1,332 @@
+"""
+End-to-end benchmarks for redcap_importer.
+
+Each scenario generates a REDCap project of a given shape, serves it with FakeRedcapServer and
+times redcap_get_dd, redcap_load_data and UploadToRedcap.upload against it, using a fresh
+SQLite database. Results are written as JSON so they can be compared between releases.
+
+How to use:
+- python benchmarks/run_benchmarks.py
+    - runs the default scenarios and writes benchmark_results.json
+- python benchmarks/run_benchmarks.py --scenario longitudinal --scenario classic_100k
+    - runs only the named scenarios (see --list for all of them)
+- --records overrides the record count of every scenario, --chunk-size, --workers and
+  --batch-size are passed through to redcap_load_data
+- --export-format csv downloads records as CSV instead of JSON
+- --upload-workers sets how many batches UploadToRedcap sends at a time, and
+  --adaptive-batch-size lets it tune the upload batch size starting from --batch-size
+- --skip-unchanged compares the upload with the loaded data and only sends what changed
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import datetime
+import importlib
+import contextlib
+import subprocess
+import tempfile
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_NAME = "benchmark_project"
+
+# shape of the generated project for each scenario, see FakeRedcapProject for the knobs
+SCENARIOS = {
+    "classic": dict(records=1000, instruments=5, fields=20),
+    "wide": dict(records=1000, instruments=5, fields=100),
+    "many_instruments": dict(records=1000, instruments=40, fields=10),
+    "checkbox_heavy": dict(records=1000, instruments=5, fields=20, checkbox_rate=0.5),
+    "longitudinal": dict(records=1000, instruments=5, fields=20, events=4, arms=2),
+    "repeating": dict(records=1000, instruments=5, fields=20, events=2, repeating=2),
+    "classic_100k": dict(records=100000, instruments=5, fields=20),
+    "longitudinal_100k": dict(records=100000, instruments=5, fields=20, events=3, repeating=1),
+}
+DEFAULT_SCENARIOS = [name for name in SCENARIOS if not name.endswith("_100k")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the redcap_importer benchmarks")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--list", action="store_true", help="list the scenarios and exit")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--records", type=int, help="override the record count of every scenario")
+    parser.add_argument(
+        "--upload-records", type=int, default=1000, help="number of records to upload"
+    )
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--export-format", choices=["json", "csv"], default="json")
+    parser.add_argument("--upload-workers", type=int, default=1)
+    parser.add_argument("--adaptive-batch-size", action="store_true")
+    parser.add_argument("--skip-unchanged", action="store_true")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.list:
+        for name, shape in SCENARIOS.items():
+            print("{:20} {}".format(name, json.dumps(shape)))
+        return 0
+    if args.run_scenario:
+        # each scenario runs in its own process so that it gets its own Django app and database
+        result = run_scenario(json.loads(args.run_scenario))
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "django": get_version("django"),
+        "redcap_importer": get_version("redcap_importer"),
+        "load_options": {
+            "chunk_size": args.chunk_size,
+            "workers": args.workers,
+            "batch_size": args.batch_size,
+            "export_format": args.export_format,
+            "upload_workers": args.upload_workers,
+            "adaptive_batch_size": args.adaptive_batch_size,
+            "skip_unchanged": args.skip_unchanged,
+        },
+        "scenarios": [],
+    }
+    failed = False
+    for name in args.scenario or DEFAULT_SCENARIOS:
+        shape = dict(SCENARIOS[name])
+        if args.records:
+            shape["records"] = args.records
+        print("running {}: {}".format(name, json.dumps(shape)))
+        config = dict(shape, name=name, upload_records=min(args.upload_records, shape["records"]))
+        config.update(results["load_options"])
+        result = run_in_subprocess(config)
+        if "error" in result:
+            failed = True
+            print("  failed: {}".format(result["error"].strip().splitlines()[-1]))
+        else:
+            for phase, stats in result["phases"].items():
+                print(
+                    "  {:10} {:8.2f}s {:10.0f} rows/s {:7} queries {:6} requests".format(
+                        phase,
+                        stats["seconds"],
+                        stats["rows_per_second"],
+                        stats["sql_queries"],
+                        stats["http_requests"],
+                    )
+                )
+            print("  peak memory {:.0f} MB".format(result["peak_memory_mb"] or 0))
+        results["scenarios"].append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("results written to {}".format(args.output))
+    return 1 if failed else 0
+
+
+def get_version(package):
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def run_in_subprocess(config):
+    with tempfile.TemporaryDirectory() as work_dir:
+        result_file = os.path.join(work_dir, "result.json")
+        process = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--run-scenario",
+                json.dumps(config),
+                "--result-file",
+                result_file,
+            ],
+            cwd=work_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        if process.returncode != 0 or not os.path.exists(result_file):
+            return {"name": config["name"], "config": config, "error": process.stdout}
+        with open(result_file) as f:
+            return json.load(f)
+
+
+def setup_django(work_dir):
+    """Sets up Django with an empty app in work_dir that the generated models are written to"""
+    import django
+    from django.conf import settings
+
+    app_dir = os.path.join(work_dir, APP_NAME)
+    os.makedirs(app_dir)
+    for file_name in ("__init__.py", "models.py"):
+        open(os.path.join(app_dir, file_name), "w").close()
+    sys.path.insert(0, work_dir)
+    sys.path.insert(0, REPO_DIR)
+    settings.configure(
+        INSTALLED_APPS=[
+            "django.contrib.contenttypes",
+            "django.contrib.auth",
+            "redcap_importer",
+            APP_NAME,
+        ],
+        DATABASES={
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": os.path.join(work_dir, "db.sqlite3"),
+            }
+        },
+        REDCAP_API_TOKENS={APP_NAME: "benchmark"},
+        DEFAULT_AUTO_FIELD="django.db.models.AutoField",
+        USE_TZ=True,
+    )
+    django.setup()
+
+
+def create_generated_tables():
+    """Loads the models written by redcap_write_models and creates their tables"""
+    from django.apps import apps
+    from django.core.management import call_command
+    from django.db import connection
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        call_command("redcap_write_models", APP_NAME)
+    app_module = importlib.import_module(APP_NAME + ".models")
+    with open(app_module.__file__, "w") as f:
+        f.write(output.getvalue())
+    importlib.reload(app_module)
+    with connection.schema_editor() as schema_editor:
+        for Model in apps.get_app_config(APP_NAME).get_models():
+            schema_editor.create_model(Model)
+
+
+def count_generated_rows():
+    from django.apps import apps
+
+    return sum(Model.objects.count() for Model in apps.get_app_config(APP_NAME).get_models())
+
+
+class PhaseTimer:
+    """Measures wall time, SQL queries and HTTP traffic of one benchmark phase"""
+
+    def __init__(self, server):
+        self.server = server
+        self.sql_queries = 0
+
+    def count_query(self, execute, sql, params, many, context):
+        self.sql_queries += 1
+        return execute(sql, params, many, context)
+
+    def run(self, func):
+        from django.db import connection
+
+        requests_before = self.server.request_count
+        bytes_before = self.server.bytes_sent
+        self.sql_queries = 0
+        start = time.perf_counter()
+        with connection.execute_wrapper(self.count_query):
+            with contextlib.redirect_stdout(io.StringIO()):
+                rows = func()
+        seconds = time.perf_counter() - start
+        return {
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "rows_per_second": round(rows / seconds, 1) if seconds else None,
+            "sql_queries": self.sql_queries,
+            "http_requests": self.server.request_count - requests_before,
+            "http_bytes_received": self.server.bytes_sent - bytes_before,
+        }
+
+
+def get_peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+def run_scenario(config):
+    setup_django(os.getcwd())
+
+    from django.core.management import call_command
+    from redcap_importer import models
+    from redcap_importer.fake_redcap import FakeRedcapProject, FakeRedcapServer
+    from redcap_importer.upload_to_redcap import UploadToRedcap
+
+    call_command("migrate", verbosity=0)
+    project = FakeRedcapProject(
+        record_count=config["records"],
+        instrument_count=config["instruments"],
+        fields_per_instrument=config["fields"],
+        event_count=config.get("events", 0),
+        arm_count=config.get("arms", 1),
+        repeating_instrument_count=config.get("repeating", 0),
+        checkbox_rate=config.get("checkbox_rate", 0.1),
+    )
+    server = FakeRedcapServer(project).start()
+    oApiUrl = models.RedcapApiUrl.objects.create(name="benchmark", url=server.url)
+    models.RedcapConnection.objects.create(
+        unique_name=APP_NAME, api_url=oApiUrl, export_format=config["export_format"]
+    )
+    timer = PhaseTimer(server)
+    phases = {}
+
+    def get_dd():
+        call_command("redcap_get_dd", APP_NAME)
+        return models.FieldMetadata.objects.count()
+
+    phases["get_dd"] = timer.run(get_dd)
+    create_generated_tables()
+
+    def load_data():
+        call_command(
+            "redcap_load_data",
+            APP_NAME,
+            chunk_size=config["chunk_size"],
+            workers=config["workers"],
+            batch_size=config["batch_size"],
+        )
+        return count_generated_rows()
+
+    phases["load_data"] = timer.run(load_data)
+
+    record_ids = project.get_record_ids()[: config["upload_records"]]
+    dataset = list(project.export_records(records=record_ids))
+
+    def upload():
+        UploadToRedcap(
+            APP_NAME,
+            batch_size=config["batch_size"],
+            workers=config["upload_workers"],
+            adaptive_batch_size=config["adaptive_batch_size"],
+            skip_unchanged=config["skip_unchanged"],
+        ).upload(dataset)
+        return len(dataset)
+
+    phases["upload"] = timer.run(upload)
+    server.stop()
+    return {
+        "name": config["name"],
+        "config": config,
+        "phases": phases,
+        "peak_memory_mb": get_peak_memory_mb(),
+    }
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.utils.html import format_html
 from . import models
 
 
@@ -14,12 +15,18 @@ class IncludeInstrumentAdmin(admin.TabularInline):  # can also use StackedInline
     extra = 3
 
 
+class IncludeFieldAdmin(admin.TabularInline):
+    model = models.IncludeField
+    extra = 3
+
+
 class RedcapConnectionAdmin(admin.ModelAdmin):
     list_display = (
         "unique_name",
         "partial_load",
+        "export_format",
     )
-    inlines = [IncludeInstrumentAdmin]
+    inlines = [IncludeInstrumentAdmin, IncludeFieldAdmin]
 
 
 admin.site.register(models.RedcapConnection, RedcapConnectionAdmin)
@@ -68,8 +75,14 @@ class InstrumentMetadataAdmin(admin.ModelAdmin):
         "instrument_will_load",
     )
     list_filter = ("project",)
+    list_select_related = ("project__connection",)
     actions = [include_instruments]
 
+    def get_queryset(self, request):
+        # instrument_will_load needs each connection's include list, fetch them all at once
+        qs = super().get_queryset(request)
+        return qs.prefetch_related("project__connection__includeinstrument_set")
+
 
 admin.site.register(models.InstrumentMetadata, InstrumentMetadataAdmin)
 
@@ -81,6 +94,17 @@ class EventInstrumentMetadataAdmin(admin.ModelAdmin):
 admin.site.register(models.EventInstrumentMetadata, EventInstrumentMetadataAdmin)
 
 
+def include_fields(modeladmin, request, queryset):
+    for oField in queryset:
+        oInclude, created = models.IncludeField.objects.get_or_create(
+            connection=oField.instrument.project.connection,
+            field_name=oField.unique_name,
+        )
+
+
+include_fields.short_description = "Include fields during data load"
+
+
 class FieldMetadataAdmin(admin.ModelAdmin):
     list_display = (
         "unique_name",
@@ -92,6 +116,7 @@ class FieldMetadataAdmin(admin.ModelAdmin):
         "field_display_lookup",
     )
     list_filter = ("instrument__project", "instrument")
+    actions = [include_fields]
 
 
 admin.site.register(models.FieldMetadata, FieldMetadataAdmin)
@@ -108,8 +133,13 @@ class EtlLogAdmin(admin.ModelAdmin):
         "query_count",
         "last_successful_record_number",
         "get_loaded_count",
+        "get_rows_written",
     )
     list_filter = ("direction", "status")
+    readonly_fields = ("metrics_summary",)
+
+    def metrics_summary(self, obj):
+        return format_html("<pre>{}</pre>", obj.get_metrics_display())
 
 
 admin.site.register(models.EtlLog, EtlLogAdmin)
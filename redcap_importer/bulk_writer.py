@@ -0,0 +1,142 @@
+from django.apps import apps
+from django.db import connections, router
+
+
+class BulkInstrumentWriter:
+    """
+    Buffers unsaved instrument records and checkbox lookup rows so they can be written with a
+    single bulk_create() per model instead of several queries per REDCap row.
+
+    How to use:
+    - pass the writer to InstrumentMetadata.create_instrument_record()
+    - records are flushed automatically every batch_size instrument records
+    - call flush() once after the last record to write whatever is left
+    - if an EtlMetrics is given, time spent writing is counted as phase "insert" along with the
+      number of rows written to each model
+    """
+
+    def __init__(self, batch_size=500, metrics=None):
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.roots = []  # unsaved ProjectRoot records
+        self.events = []  # unsaved RedcapEvent records
+        self.instruments = {}  # instrument model -> list of unsaved instrument records
+        self.lookups = {}  # lookup model -> list of (foreign key name, instrument record, values)
+        self.pending_count = 0
+
+    def add_root(self, oRoot):
+        self.roots.append(oRoot)
+
+    def add_event(self, oEvent):
+        self.events.append(oEvent)
+
+    def add_instrument(self, oInstrument):
+        self.instruments.setdefault(oInstrument.__class__, []).append(oInstrument)
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            self.flush()
+
+    def add_lookup(self, LookupModel, fk_name, oInstrument, values):
+        """
+        Lookup rows point to an instrument record that may not have a primary key yet, so the
+        row itself is only built in flush() once its instrument has been saved.
+        """
+        self.lookups.setdefault(LookupModel, []).append((fk_name, oInstrument, values))
+
+    def flush(self):
+        if self.metrics:
+            with self.metrics.phase("insert"):
+                self._flush()
+        else:
+            self._flush()
+
+    def _flush(self):
+        # write each level before the records that point to it: roots, events, instruments and
+        # then lookup rows
+        if self.roots:
+            self._bulk_create(self.roots[0].__class__, self.roots)
+        if self.events:
+            self._bulk_create(self.events[0].__class__, self.events, need_pk=True)
+        for InstrumentModel, records in self.instruments.items():
+            self._bulk_create(InstrumentModel, records, need_pk=True)
+        for LookupModel, rows in self.lookups.items():
+            records = []
+            for fk_name, oInstrument, values in rows:
+                args = dict(values)
+                args[fk_name] = oInstrument
+                records.append(LookupModel(**args))
+            self._bulk_create(LookupModel, records)
+        self.roots = []
+        self.events = []
+        self.instruments = {}
+        self.lookups = {}
+        self.pending_count = 0
+
+    def _bulk_create(self, Model, records, need_pk=False):
+        if not records:
+            return
+        db = router.db_for_write(Model)
+        for record in records:
+            # foreign keys assigned before their target was saved don't have an id yet
+            for field in Model._meta.concrete_fields:
+                if field.is_relation and getattr(record, field.attname) is None:
+                    if field.is_cached(record):
+                        setattr(record, field.name, getattr(record, field.name))
+        if not need_pk or connections[db].features.can_return_rows_from_bulk_insert:
+            Model.objects.using(db).bulk_create(records, batch_size=self.batch_size)
+        else:
+            # backend can't hand back primary keys from a bulk insert (ex. MySQL), and lookup
+            # rows need them, so fall back to one INSERT per record
+            for record in records:
+                record.save(using=db)
+        if self.metrics:
+            self.metrics.add_rows(Model._meta.label, len(records))
+
+
+class RecordIdentityMap:
+    """
+    Keeps the ProjectRoot and RedcapEvent records for a load, keyed by record id and by
+    (record id, event name), so each is only created once. They are handed to the
+    BulkInstrumentWriter unsaved and written in bulk before the instruments that use them.
+
+    redcap_load_data deletes every record it is about to load first, so none of them are in the
+    database yet and nothing needs to be looked up.
+    """
+
+    def __init__(self, oProject, writer):
+        app_name = oProject.connection.unique_name
+        self.ProjectRoot = apps.get_model(app_label=app_name, model_name="ProjectRoot")
+        self.RedcapEvent = None
+        if oProject.is_longitudinal:
+            self.RedcapEvent = apps.get_model(app_label=app_name, model_name="RedcapEvent")
+        self.event_metadata = {}
+        for oEventMetadata in oProject.eventmetadata_set.select_related("arm"):
+            self.event_metadata[oEventMetadata.unique_name] = oEventMetadata
+        self.writer = writer
+        self.roots = {}
+        self.events = {}
+
+    def get_root(self, pk):
+        oRoot = self.roots.get(pk)
+        if oRoot is None:
+            # TO DO: set pk_label by looking up
+            oRoot = self.ProjectRoot(pk=pk)
+            self.writer.add_root(oRoot)
+            self.roots[pk] = oRoot
+        return oRoot
+
+    def get_event(self, oRoot, event_name):
+        #!! TO DO: consider how repeatable entire events would work
+        key = (oRoot.pk, event_name)
+        oEvent = self.events.get(key)
+        if oEvent is None:
+            oEventMetadata = self.event_metadata[event_name]
+            oEvent = self.RedcapEvent(
+                project_root=oRoot,
+                event_unique_name=oEventMetadata.unique_name,
+                event_label=oEventMetadata.label,
+                arm_number=oEventMetadata.arm.arm_number,
+            )
+            self.writer.add_event(oEvent)
+            self.events[key] = oEvent
+        return oEvent
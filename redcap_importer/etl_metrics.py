@@ -0,0 +1,97 @@
+import time
+import threading
+import contextlib
+
+from django.db import connections
+
+_DONE = object()
+
+
+class EtlMetrics:
+    """
+    Collects where the time goes during a load or upload, to be saved as JSON with the EtlLog.
+
+    How to use:
+    - wrap each step in `with metrics.phase(name):`, or a generator in metrics.timed(items, name)
+        - phases can be nested, time spent in an inner phase is not counted for the outer one
+        - phases run on worker threads are added up, so they can total more than the wall time
+    - count_queries() counts SQL statements run by the current thread inside the block
+    - add_rows() and add_http() count rows written and HTTP traffic
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.rows = {}
+        self.sql_queries = 0
+        self.http_bytes_sent = 0
+        self.http_bytes_received = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self.local.__dict__.setdefault("stack", [])
+        now = time.perf_counter()
+        if stack:
+            # pause the enclosing phase
+            self._add_time(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._add_time(name, now - stack.pop()[1])
+            if stack:
+                stack[-1][1] = now
+
+    def timed(self, items, name):
+        """Yields from items, counting the time spent producing each item as phase name"""
+        items = iter(items)
+        while True:
+            with self.phase(name):
+                item = next(items, _DONE)
+            if item is _DONE:
+                return
+            yield item
+
+    def add_rows(self, name, count):
+        with self.lock:
+            self.rows[name] = self.rows.get(name, 0) + count
+
+    def add_http(self, bytes_sent=0, bytes_received=0):
+        with self.lock:
+            self.http_bytes_sent += bytes_sent
+            self.http_bytes_received += bytes_received
+
+    def count_received(self, chunks):
+        """Yields from an iterable of response body chunks, counting their size"""
+        for chunk in chunks:
+            self.add_http(bytes_received=len(chunk))
+            yield chunk
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.sql_queries += 1
+        return execute(sql, params, many, context)
+
+    @contextlib.contextmanager
+    def count_queries(self):
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self._count_query))
+            yield
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "wall_seconds": round(time.perf_counter() - self.started, 3),
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "rows": dict(self.rows),
+                "sql_queries": self.sql_queries,
+                "http_bytes_sent": self.http_bytes_sent,
+                "http_bytes_received": self.http_bytes_received,
+            }
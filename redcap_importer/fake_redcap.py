@@ -0,0 +1,595 @@
+import io
+import csv
+import json
+import time
+import random
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+# REDCap field types the fake project cycles through besides checkboxes: (field_type, validation type)
+FIELD_TYPES = (
+    ("text", ""),
+    ("text", "number"),
+    ("text", "integer"),
+    ("text", "date_mdy"),
+    ("yesno", ""),
+    ("radio", ""),
+    ("dropdown", ""),
+    ("notes", ""),
+    ("calc", ""),
+)
+CHOICES = (("1", "Never"), ("2", "Sometimes"), ("3", "Often"), ("4", "Always"))
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class FakeRedcapProject:
+    """
+    A generated REDCap project for FakeRedcapServer to serve.
+
+    Data is generated on demand from the seed, so a project with many records doesn't need to be
+    held in memory. Only records changed through a record import are stored.
+
+    How to use:
+    - set the shape of the project with init (records, instruments, fields, events, etc.)
+    - pass it to a FakeRedcapServer
+    """
+
+    def __init__(
+        self,
+        record_count=100,
+        instrument_count=3,
+        fields_per_instrument=10,
+        event_count=0,
+        arm_count=1,
+        repeating_instrument_count=0,
+        checkbox_rate=0.1,
+        repeat_instances=2,
+        fill_rate=0.9,
+        seed=0,
+        title="Fake REDCap Project",
+    ):
+        self.record_count = record_count
+        self.repeat_instances = repeat_instances
+        self.fill_rate = fill_rate
+        self.seed = seed
+        self.title = title
+        self.is_longitudinal = event_count > 0
+        self.primary_key_field = "record_id"
+        self.created = datetime.datetime(2020, 1, 1)
+        self.lock = threading.Lock()
+        self.imported = {}  # (record id, event, repeat instrument, repeat instance) -> row
+        self.imported_instances = {}  # (record id, event, repeat instrument) -> set of instances
+        self.modified = {}  # record id -> time last changed by an import
+        self.imported_events = {}  # record id -> set of events changed by an import
+        self.extra_record_ids = []  # records created by an import, in order
+        self.extra_record_set = set()
+
+        self.instruments = ["instrument_{}".format(i + 1) for i in range(instrument_count)]
+        self.repeating_instruments = self.instruments[
+            len(self.instruments) - repeating_instrument_count :
+        ]
+        # every arm gets event_count events, records are spread evenly across the arms
+        self.arms = [(arm_num, "Arm {}".format(arm_num)) for arm_num in range(1, arm_count + 1)]
+        self.arm_events = {}
+        for arm_num, name in self.arms:
+            self.arm_events[arm_num] = [
+                "event_{}_arm_{}".format(i + 1, arm_num) for i in range(event_count)
+            ]
+        self.events = [event for arm_num, name in self.arms for event in self.arm_events[arm_num]]
+
+        # field metadata in the format of the REDCap metadata export
+        self.metadata = []
+        self.form_fields = {}  # instrument -> list of (field name, field type, validation type)
+        for instrument_idx, instrument in enumerate(self.instruments):
+            self.form_fields[instrument] = []
+            if instrument_idx == 0:
+                self.form_fields[instrument].append((self.primary_key_field, "text", ""))
+            checkbox_count = 0
+            for field_idx in range(fields_per_instrument):
+                # spread checkboxes evenly so that checkbox_rate of the fields are checkboxes
+                if int((field_idx + 1) * checkbox_rate) > int(field_idx * checkbox_rate):
+                    field_type, validation = "checkbox", ""
+                    checkbox_count += 1
+                else:
+                    field_type, validation = FIELD_TYPES[
+                        (field_idx - checkbox_count) % len(FIELD_TYPES)
+                    ]
+                field_name = "i{}_f{}".format(instrument_idx + 1, field_idx + 1)
+                self.form_fields[instrument].append((field_name, field_type, validation))
+            for field_name, field_type, validation in self.form_fields[instrument]:
+                choices = ""
+                if field_type in ("radio", "dropdown", "checkbox"):
+                    choices = " | ".join("{}, {}".format(code, label) for code, label in CHOICES)
+                elif field_type == "calc":
+                    choices = "1+1"
+                self.metadata.append(
+                    {
+                        "field_name": field_name,
+                        "form_name": instrument,
+                        "section_header": "",
+                        "field_type": field_type,
+                        "field_label": field_name.replace("_", " "),
+                        "select_choices_or_calculations": choices,
+                        "field_note": "",
+                        "text_validation_type_or_show_slider_number": validation,
+                        "text_validation_min": "",
+                        "text_validation_max": "",
+                        "identifier": "",
+                        "branching_logic": "",
+                        "required_field": "",
+                        "custom_alignment": "",
+                        "question_number": "",
+                        "matrix_group_name": "",
+                        "matrix_ranking": "",
+                        "field_annotation": "",
+                    }
+                )
+
+        # export columns for each instrument, in the order REDCap exports them
+        self.form_columns = {}
+        for instrument in self.instruments:
+            columns = []
+            for field_name, field_type, validation in self.form_fields[instrument]:
+                if field_name == self.primary_key_field:
+                    continue
+                if field_type == "checkbox":
+                    for code, label in CHOICES:
+                        columns.append("{}___{}".format(field_name, code))
+                else:
+                    columns.append(field_name)
+            columns.append("{}_complete".format(instrument))
+            self.form_columns[instrument] = columns
+        self.key_columns = [self.primary_key_field]
+        if self.is_longitudinal:
+            self.key_columns.append("redcap_event_name")
+        if self.repeating_instruments:
+            self.key_columns += ["redcap_repeat_instrument", "redcap_repeat_instance"]
+        self.columns = list(self.key_columns)
+        for instrument in self.instruments:
+            self.columns += self.form_columns[instrument]
+
+    # project structure exports
+
+    def export_project(self):
+        return {
+            "project_id": 1,
+            "project_title": self.title,
+            "creation_time": self.created.strftime(DATE_FORMAT),
+            "in_production": 0,
+            "is_longitudinal": 1 if self.is_longitudinal else 0,
+            "has_repeating_instruments_or_events": 1 if self.repeating_instruments else 0,
+        }
+
+    def export_field_names(self):
+        names = []
+        for field in self.metadata:
+            field_name = field["field_name"]
+            if field["field_type"] == "checkbox":
+                for code, label in CHOICES:
+                    names.append(
+                        {
+                            "original_field_name": field_name,
+                            "choice_value": code,
+                            "export_field_name": "{}___{}".format(field_name, code),
+                        }
+                    )
+            else:
+                names.append(
+                    {
+                        "original_field_name": field_name,
+                        "choice_value": "",
+                        "export_field_name": field_name,
+                    }
+                )
+        return names
+
+    def export_arms(self):
+        return [{"arm_num": arm_num, "name": name} for arm_num, name in self.arms]
+
+    def export_events(self):
+        return [
+            {
+                "event_name": event.rsplit("_arm_", 1)[0].replace("_", " ").title(),
+                "arm_num": int(event.rsplit("_arm_", 1)[1]),
+                "unique_event_name": event,
+                "custom_event_label": "",
+                "event_id": idx + 1,
+                "days_offset": idx,
+                "offset_min": 0,
+                "offset_max": 0,
+            }
+            for idx, event in enumerate(self.events)
+        ]
+
+    def export_instruments(self):
+        return [
+            {
+                "instrument_name": instrument,
+                "instrument_label": instrument.replace("_", " ").title(),
+            }
+            for instrument in self.instruments
+        ]
+
+    def export_form_event_mapping(self):
+        mapping = []
+        for event in self.events:
+            for instrument in self.instruments:
+                arm_num = int(event.rsplit("_arm_", 1)[1])
+                mapping.append({"arm_num": arm_num, "unique_event_name": event, "form": instrument})
+        return mapping
+
+    def export_repeating_forms_events(self):
+        response = []
+        for instrument in self.repeating_instruments:
+            if self.is_longitudinal:
+                for event in self.events:
+                    response.append(
+                        {"event_name": event, "form_name": instrument, "custom_form_label": ""}
+                    )
+            else:
+                response.append({"form_name": instrument, "custom_form_label": ""})
+        return response
+
+    # record data
+
+    def get_record_ids(self):
+        return [str(i + 1) for i in range(self.record_count)] + self.extra_record_ids
+
+    def is_generated_record(self, record_id):
+        return record_id.isdigit() and 1 <= int(record_id) <= self.record_count
+
+    def has_record(self, record_id):
+        return self.is_generated_record(record_id) or record_id in self.extra_record_set
+
+    def generate_value(self, rnd, field_name, field_type, validation):
+        if field_type == "text" and validation == "number":
+            return "{:.2f}".format(rnd.uniform(0, 200))
+        if field_type == "text" and validation == "integer":
+            return str(rnd.randint(0, 100))
+        if field_type == "text" and validation == "date_mdy":
+            date = datetime.date(1950, 1, 1) + datetime.timedelta(days=rnd.randint(0, 25000))
+            return date.isoformat()
+        if field_type == "yesno":
+            return rnd.choice(("0", "1"))
+        if field_type in ("radio", "dropdown"):
+            return rnd.choice(CHOICES)[0]
+        if field_type == "notes":
+            return " ".join(
+                rnd.choice(("lorem", "ipsum", "dolor", "sit", "amet")) for i in range(12)
+            )
+        if field_type == "calc":
+            return str(rnd.randint(0, 10))
+        return "{} {}".format(field_name, rnd.randint(0, 10000))
+
+    def generate_form(self, row, record_id, event, instrument, instance):
+        rnd = random.Random(
+            "{}|{}|{}|{}|{}".format(self.seed, record_id, event, instrument, instance)
+        )
+        if rnd.random() > self.fill_rate:
+            return
+        for field_name, field_type, validation in self.form_fields[instrument]:
+            if field_name == self.primary_key_field:
+                continue
+            if field_type == "checkbox":
+                for code, label in CHOICES:
+                    row["{}___{}".format(field_name, code)] = "1" if rnd.random() < 0.3 else "0"
+            elif rnd.random() < 0.95:
+                row[field_name] = self.generate_value(rnd, field_name, field_type, validation)
+        row["{}_complete".format(instrument)] = "2"
+
+    def new_row(self, record_id, event, repeat_instrument="", repeat_instance=""):
+        row = dict.fromkeys(self.columns, "")
+        row[self.primary_key_field] = record_id
+        if self.is_longitudinal:
+            row["redcap_event_name"] = event
+        if self.repeating_instruments:
+            row["redcap_repeat_instrument"] = repeat_instrument
+            row["redcap_repeat_instance"] = repeat_instance
+        return row
+
+    def get_record_events(self, record_id):
+        """Generated records have data on every event of their arm, others where imported"""
+        if not self.is_longitudinal:
+            return [""]
+        if self.is_generated_record(record_id):
+            return self.arm_events[(int(record_id) - 1) % len(self.arms) + 1]
+        imported_events = self.imported_events.get(record_id, set())
+        return [event for event in self.events if event in imported_events]
+
+    def iter_record_rows(self, record_id):
+        """Yields the export rows for one record: a base row and repeat rows for each event"""
+        generated = self.is_generated_record(record_id)
+        for event in self.get_record_events(record_id):
+            if generated or (record_id, event, "", "") in self.imported:
+                row = self.new_row(record_id, event)
+                for instrument in self.instruments:
+                    if instrument in self.repeating_instruments:
+                        continue
+                    for column in self.form_columns[instrument]:
+                        if "___" in column:
+                            row[column] = "0"  # unchecked boxes export as 0 on base rows
+                    if generated:
+                        self.generate_form(row, record_id, event, instrument, "")
+                row.update(self.imported.get((record_id, event, "", ""), {}))
+                yield row
+            for instrument in self.repeating_instruments:
+                instances = []
+                if generated:
+                    instances = [str(i) for i in range(1, self.repeat_instances + 1)]
+                imported = self.imported_instances.get((record_id, event, instrument), set())
+                instances += sorted(imported.difference(instances), key=int)
+                for instance in instances:
+                    row = self.new_row(record_id, event, instrument, instance)
+                    if generated:
+                        self.generate_form(row, record_id, event, instrument, instance)
+                    row.update(self.imported.get((record_id, event, instrument, instance), {}))
+                    yield row
+
+    def get_export_columns(self, fields=None, forms=None):
+        """Returns the columns a record export has, in order"""
+        if not (fields or forms):
+            return list(self.columns)
+        columns = set(self.key_columns)
+        for instrument in forms or []:
+            columns.update(self.form_columns.get(instrument, []))
+        for field_name in fields or []:
+            for column in self.columns:
+                if column == field_name or column.startswith(field_name + "___"):
+                    columns.add(column)
+        return [column for column in self.columns if column in columns]
+
+    def export_records(self, records=None, fields=None, forms=None, date_range_begin=None):
+        """Yields export rows, optionally filtered like the REDCap record export"""
+        columns = None
+        if fields or forms:
+            columns = set(self.get_export_columns(fields, forms))
+        for record_id in records or self.get_record_ids():
+            if not self.has_record(record_id):
+                continue
+            if date_range_begin and self.modified.get(record_id, self.created) < date_range_begin:
+                continue
+            for row in self.iter_record_rows(record_id):
+                if columns is not None:
+                    row = {column: value for column, value in row.items() if column in columns}
+                yield row
+
+    def import_records(self, data):
+        """Stores rows uploaded through a record import and returns the number of records"""
+        record_ids = set()
+        with self.lock:
+            for entry in data:
+                record_id = str(entry[self.primary_key_field])
+                if not self.has_record(record_id):
+                    self.extra_record_ids.append(record_id)
+                    self.extra_record_set.add(record_id)
+                key = (
+                    record_id,
+                    entry.get("redcap_event_name", "") if self.is_longitudinal else "",
+                    entry.get("redcap_repeat_instrument", ""),
+                    str(entry.get("redcap_repeat_instance", "")),
+                )
+                values = self.imported.setdefault(key, {})
+                self.imported_events.setdefault(record_id, set()).add(key[1])
+                if key[2]:
+                    self.imported_instances.setdefault(key[:3], set()).add(key[3])
+                for column, value in entry.items():
+                    if column in self.columns and column not in self.key_columns:
+                        values[column] = "" if value is None else str(value)
+                self.modified[record_id] = datetime.datetime.now()
+                record_ids.add(record_id)
+        return len(record_ids)
+
+
+class FakeRedcapServer:
+    """
+    A local stand-in for the REDCap API, for testing and measuring the management commands and
+    UploadToRedcap without a live REDCap instance.
+
+    How to use:
+    - create a FakeRedcapProject and pass it in with any latency or error rate to inject
+    - set max_request_bytes to answer larger requests with HTTP 413, like a web server limit
+    - start() runs the server on a background thread, stop() shuts it down
+    - set RedcapApiUrl.url to server.url, any API token is accepted unless token is set
+    - request_count, connection_count and bytes_sent count the traffic served so far
+    """
+
+    def __init__(
+        self,
+        project,
+        host="127.0.0.1",
+        port=0,
+        token=None,
+        latency=0,
+        error_rate=0,
+        seed=0,
+        max_request_bytes=None,
+    ):
+        self.project = project
+        self.token = token
+        self.latency = latency  # seconds to wait before answering each request
+        self.error_rate = error_rate  # fraction of requests answered with an HTTP 500 error
+        self.max_request_bytes = max_request_bytes
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.connection_count = 0  # TCP connections opened by clients
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), FakeRedcapRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake_redcap = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle_request(self, params):
+        """Returns (HTTP status, response body) for the POSTed API parameters"""
+        with self.lock:
+            self.request_count += 1
+            inject_error = self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if inject_error:
+            return 500, {"error": "injected error"}
+        if self.token and params.get("token") != self.token:
+            return 403, {"error": "You do not have permissions to use the API"}
+        content = params.get("content")
+        project = self.project
+        exports = {
+            "project": project.export_project,
+            "exportFieldNames": project.export_field_names,
+            "arm": project.export_arms,
+            "event": project.export_events,
+            "instrument": project.export_instruments,
+            "formEventMapping": project.export_form_event_mapping,
+            "repeatingFormsEvents": project.export_repeating_forms_events,
+            "metadata": lambda: project.metadata,
+        }
+        if content in exports:
+            if content in ("arm", "event", "formEventMapping") and not project.is_longitudinal:
+                return 400, {"error": "You cannot export arms or events for classic projects"}
+            return 200, exports[content]()
+        if content == "record" and "data" in params:
+            try:
+                data = json.loads(params["data"])
+            except ValueError:
+                return 400, {"error": "The data being imported is not formatted correctly"}
+            return 200, {"count": project.import_records(data)}
+        if content == "record":
+            date_range_begin = None
+            if params.get("dateRangeBegin"):
+                date_range_begin = datetime.datetime.strptime(params["dateRangeBegin"], DATE_FORMAT)
+            fields = get_list_param(params, "fields")
+            forms = get_list_param(params, "forms")
+            rows = project.export_records(
+                records=get_list_param(params, "records"),
+                fields=fields,
+                forms=forms,
+                date_range_begin=date_range_begin,
+            )
+            if params.get("format") == "csv":
+                return 200, CsvExport(project.get_export_columns(fields, forms), rows)
+            return 200, rows
+        return 400, {"error": "The value of the parameter content is not valid"}
+
+
+class CsvExport:
+    """Record export rows to be sent as CSV with a header row, like REDCap does for format=csv"""
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+
+def get_list_param(params, name):
+    """Reads a list sent as name=a,b or as name[0]=a&name[1]=b"""
+    values = []
+    if params.get(name):
+        values += [value.strip() for value in params[name].split(",") if value.strip()]
+    idx = 0
+    while "{}[{}]".format(name, idx) in params:
+        values.append(params["{}[{}]".format(name, idx)])
+        idx += 1
+    return values
+
+
+class FakeRedcapRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections open between requests like a real server
+
+    def setup(self):
+        super().setup()
+        with self.server.fake_redcap.lock:
+            self.server.fake_redcap.connection_count += 1
+
+    def do_POST(self):
+        fake_redcap = self.server.fake_redcap
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        if fake_redcap.max_request_bytes and length > fake_redcap.max_request_bytes:
+            with fake_redcap.lock:
+                fake_redcap.request_count += 1
+            self.send_response(413)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_body(b"<html><body>Request Entity Too Large</body></html>")
+            return
+        params = {key: values[-1] for key, values in parse_qs(body, keep_blank_values=True).items()}
+        status, response = fake_redcap.handle_request(params)
+        self.send_response(status)
+        if isinstance(response, CsvExport):
+            self.send_header("Content-Type", "text/csv; charset=utf-8")
+            self.send_csv(response)
+            return
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if isinstance(response, (dict, list)):
+            self.send_body(json.dumps(response).encode("utf-8"))
+        else:
+            self.send_rows(response)
+
+    def send_body(self, body):
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.count_bytes(len(body))
+
+    def send_rows(self, rows):
+        # stream large exports as a chunked JSON list instead of building them in memory
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.write_chunk(b"[")
+        separator = b""
+        batch = []
+        for row in rows:
+            batch.append(separator + json.dumps(row).encode("utf-8"))
+            separator = b","
+            if len(batch) >= 100:
+                self.write_chunk(b"".join(batch))
+                batch = []
+        batch.append(b"]")
+        self.write_chunk(b"".join(batch))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_csv(self, export):
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(export.columns)
+        for idx, row in enumerate(export.rows):
+            writer.writerow([row.get(column, "") for column in export.columns])
+            if idx % 100 == 99:
+                self.write_chunk(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.getvalue():
+            self.write_chunk(buffer.getvalue().encode("utf-8"))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        self.wfile.write("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+        self.count_bytes(len(data))
+
+    def count_bytes(self, count):
+        with self.server.fake_redcap.lock:
+            self.server.fake_redcap.bytes_sent += count
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,287 @@
+import datetime
+import functools
+
+from dateutil.parser import parse
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+
+
+def to_boolean(value):
+    if value is True or value == 1 or value == "1":
+        return True
+    if value is False or value == 0 or value == "0":
+        return False
+    if value is None:
+        return None
+    raise ValueError(value)
+
+
+def to_form_status(value):
+    """Form status as stored in redcap_form_status: 0 (incomplete), 1 (unverified) or 2 (complete)"""
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_date(value):
+    return parse(value).date()
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_iso_date(value):
+    """
+    The REDCap API exports dates as YYYY-MM-DD whatever their validation type (date_mdy,
+    date_dmy, date_ymd), so try that first and only fall back to dateutil. Dates tend to repeat
+    across records, so results are cached.
+    """
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        return parse_date(value)
+
+
+def get_date_parser(validation_type):
+    # fields loaded before the validation type was saved are date_mdy, the only type mapped to
+    # DateField by redcap_get_dd
+    if not validation_type or validation_type.startswith("date_"):
+        return parse_iso_date
+    return parse_date
+
+
+# django_data_type: (converter, message if conversion fails), values that fail are left empty
+# any other data type (ex. TextField) is stored as the string REDCap returns
+CONVERTERS = {
+    "FloatField": (float, "unable to convert string to float for {}: {}"),
+    "IntegerField": (int, "unable to convert string to integer for {}: {}"),
+    "DateField": (parse_date, "unable to convert string to date for {}: {}"),
+    "BooleanField": (
+        to_boolean,
+        "Unrecognized value for boolean field for {}, setting to None: {}",
+    ),
+}
+
+# values of a whole boolean column are looked up here, anything else is an error
+BOOLEAN_VALUES = {"1": True, "0": False, "": None}
+
+DISPLAY_ERROR_MESSAGE = "no display value for {}: {}"
+
+
+def columns_have_data(entry, data_columns):
+    """True if any of the (column, value when empty) pairs has a value in the REDCap row"""
+    get = entry.get
+    for column, empty_value in data_columns:
+        value = get(column)
+        if value and value != empty_value:
+            return True
+    return False
+
+
+class FieldLoadPlan:
+    """
+    Everything needed to copy one REDCap field into an instrument record, worked out once from
+    FieldMetadata so that loading a row doesn't need any metadata queries or JSON parsing.
+    """
+
+    def __init__(self, oField):
+        self.label = str(oField)
+        self.unique_name = oField.unique_name
+        self.django_field_name = oField.get_django_field_name()
+        self.display_field_name = self.django_field_name + "_display_value"
+        self.lookup = oField.get_display_lookup()
+        self.is_many_to_many = oField.is_many_to_many
+        self.django_data_type = oField.django_data_type
+        self.converter, self.error_message = CONVERTERS.get(oField.django_data_type, (None, None))
+        if oField.django_data_type == "DateField":
+            self.converter = get_date_parser(oField.validation_type)
+        # (choice key, REDCap export column, display value) for each checkbox choice
+        self.checkbox_columns = []
+        self.LookupModel = None
+        self.lookup_fk_name = None
+        if self.is_many_to_many:
+            for key, column in oField._get_many_to_many_redcap_fields().items():
+                self.checkbox_columns.append((key, column, self.lookup[key]))
+            self.LookupModel = oField.get_actual_lookup_model()
+            self.lookup_fk_name = oField.instrument.get_django_model_name()
+
+    def get_data_columns(self):
+        """
+        Returns (REDCap export column, value the column has when empty) for each column of this
+        field. Checkboxes are exported as one column per choice that is "0" when unchecked.
+        """
+        if self.is_many_to_many:
+            return [(column, "0") for key, column, display_value in self.checkbox_columns]
+        return [(self.unique_name, "")]
+
+    def convert_column(self, raw_values, errors):
+        """
+        Converts a column of values exported by REDCap. Returns a list with None wherever the value
+        was empty or couldn't be converted, and adds (message, field name, value) to errors for
+        each value that couldn't be converted.
+        """
+        if not self.converter:
+            return [raw_value if raw_value != "" else None for raw_value in raw_values]
+        # cast the whole column in one go, most columns don't have a single bad value
+        try:
+            if self.django_data_type == "BooleanField":
+                return [BOOLEAN_VALUES[raw_value] for raw_value in raw_values]
+            converter = self.converter
+            return [converter(raw_value) if raw_value != "" else None for raw_value in raw_values]
+        except (ValueError, KeyError):
+            pass
+        # go value by value to find the ones that can't be converted
+        values = []
+        for raw_value in raw_values:
+            if raw_value == "":
+                values.append(None)
+                continue
+            try:
+                values.append(self.converter(raw_value))
+            except ValueError:
+                errors.append((self.error_message, self.django_field_name, raw_value))
+                values.append(None)
+        return values
+
+    def display_column(self, values, errors):
+        """Looks up the display value for each value in a converted column"""
+        display_values = []
+        for value in values:
+            if value is None:
+                display_values.append(None)
+                continue
+            display_value = self.lookup.get(value.lower())
+            if display_value is None:
+                errors.append((DISPLAY_ERROR_MESSAGE, self.label, value))
+            display_values.append(display_value)
+        return display_values
+
+    def build_columns(self, entries, errors):
+        """
+        Returns [(django field name, column of values)] for a batch of REDCap rows: the converted
+        values and, for fields with choices, their display values. Not for checkbox fields.
+        """
+        values = self.convert_column([entry.get(self.unique_name, "") for entry in entries], errors)
+        columns = [(self.django_field_name, values)]
+        if self.lookup:
+            columns.append((self.display_field_name, self.display_column(values, errors)))
+        return columns
+
+    def add_lookups(self, entry, oRecord, writer=None):
+        """Adds a lookup row for each checked choice of a checkbox field"""
+        for key, column, display_value in self.checkbox_columns:
+            if entry.get(column) != "1":
+                continue
+            values = {
+                self.django_field_name: key,
+                self.display_field_name: display_value,
+            }
+            if writer:
+                writer.add_lookup(self.LookupModel, self.lookup_fk_name, oRecord, values)
+            else:
+                values[self.lookup_fk_name] = oRecord
+                self.LookupModel(**values).save()
+
+
+class InstrumentLoadPlan:
+    """
+    A compiled version of an InstrumentMetadata and its FieldMetadata, built once per load by
+    InstrumentMetadata.get_load_plan() and reused for every REDCap row.
+    """
+
+    def __init__(self, oInstrumentMetadata):
+        self.unique_name = oInstrumentMetadata.unique_name
+        self.InstrumentModel = apps.get_model(
+            app_label=oInstrumentMetadata.project.connection.unique_name,
+            model_name=oInstrumentMetadata.get_django_model_name(),
+        )
+        self.fields = [FieldLoadPlan(oField) for oField in oInstrumentMetadata.get_fields_to_load()]
+        self.value_fields = [field for field in self.fields if not field.is_many_to_many]
+        self.checkbox_fields = [field for field in self.fields if field.is_many_to_many]
+        # every column that makes a row worth saving when it isn't empty, checked by has_data()
+        self.data_columns = tuple(
+            (column, empty_value)
+            for field in self.fields
+            for column, empty_value in field.get_data_columns()
+        )
+        # the [instrument]_complete column is stored in redcap_form_status, models generated before
+        # that column was added don't have it
+        self.status_column = self.unique_name + "_complete"
+        try:
+            self.InstrumentModel._meta.get_field("redcap_form_status")
+            self.has_form_status = True
+        except FieldDoesNotExist:
+            self.has_form_status = False
+        # instrument records point to a RedcapEvent in longitudinal projects, otherwise a root
+        if oInstrumentMetadata.project.is_longitudinal:
+            self.parent_field_name = "redcap_event"
+        else:
+            self.parent_field_name = "project_root"
+
+    def has_data(self, entry):
+        return columns_have_data(entry, self.data_columns)
+
+    def create_record(self, entry, oRoot=None, oEvent=None, writer=None):
+        # EITHER OROOT OR OEVENT SHOULD BE SET, NOT BOTH
+        # go ahead and return none if no data
+        records = self.create_records([entry], [oRoot or oEvent], writer=writer)
+        return records[0] if records else None
+
+    def create_records(self, entries, parents, writer=None, errors=None):
+        """
+        Builds instrument records for a batch of REDCap rows, skipping rows without data. parents
+        has the ProjectRoot (or RedcapEvent for longitudinal projects) for each row.
+
+        Values are converted a column at a time and each record is built straight from its row
+        of the converted columns. If errors is a list, conversion problems are added to it as
+        (message, field name, value) instead of being printed.
+
+        If a BulkInstrumentWriter is given, records are handed to it unsaved.
+        """
+        rows = [(entry, parent) for entry, parent in zip(entries, parents) if self.has_data(entry)]
+        if not rows:
+            return []
+        entries = [entry for entry, parent in rows]
+        report_errors = errors is None
+        if report_errors:
+            errors = []
+
+        names = [self.parent_field_name, "redcap_repeat_instance"]
+        columns = [
+            [parent for entry, parent in rows],
+            [
+                (
+                    int(entry["redcap_repeat_instance"])
+                    if entry.get("redcap_repeat_instance", "") != ""
+                    else None
+                )
+                for entry in entries
+            ],
+        ]
+        if self.has_form_status:
+            names.append("redcap_form_status")
+            columns.append([to_form_status(entry.get(self.status_column)) for entry in entries])
+        for field in self.value_fields:
+            for name, values in field.build_columns(entries, errors):
+                names.append(name)
+                columns.append(values)
+        records = [self.InstrumentModel(**dict(zip(names, row))) for row in zip(*columns)]
+
+        if writer:
+            for oRecord in records:
+                writer.add_instrument(oRecord)
+        else:
+            for oRecord in records:
+                oRecord.save()
+        # lookup rows can only be saved once the instrument record has a primary key, or go to
+        # the writer after their record
+        for entry, oRecord in zip(entries, records):
+            for field in self.checkbox_fields:
+                field.add_lookups(entry, oRecord, writer=writer)
+
+        if report_errors:
+            for message, name, value in errors:
+                print(message.format(name, value))
+        return records
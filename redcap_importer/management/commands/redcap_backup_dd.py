@@ -35,6 +35,7 @@ class Command(BaseCommand):
             "redcap_importer.RedcapApiUrl",
             "redcap_importer.RedcapConnection",
             "redcap_importer.IncludeInstrument",
+            "redcap_importer.IncludeField",
             "redcap_importer.ProjectMetadata",
             "redcap_importer.ArmMetadata",
             "redcap_importer.EventMetadata",
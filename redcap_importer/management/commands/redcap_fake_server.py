@@ -0,0 +1,85 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from redcap_importer.fake_redcap import FakeRedcapProject, FakeRedcapServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a local stand-in for the REDCap API serving a generated project, so "
+        "redcap_get_dd, redcap_load_data and UploadToRedcap can be run without a live REDCap"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--token", help="only accept this API token (default: accept any)")
+        parser.add_argument("--records", type=int, default=100, help="number of records")
+        parser.add_argument("--instruments", type=int, default=3, help="number of instruments")
+        parser.add_argument(
+            "--fields", type=int, default=10, help="number of fields on each instrument"
+        )
+        parser.add_argument(
+            "--events",
+            type=int,
+            default=0,
+            help="number of events in each arm, the project is longitudinal if more than 0",
+        )
+        parser.add_argument("--arms", type=int, default=1, help="number of arms")
+        parser.add_argument(
+            "--repeating", type=int, default=0, help="number of repeating instruments"
+        )
+        parser.add_argument(
+            "--checkbox-rate",
+            type=float,
+            default=0.1,
+            help="fraction of the fields that are checkboxes (0 to 1)",
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0, help="seconds to wait before each response"
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0,
+            help="fraction of requests to answer with an HTTP 500 error (0 to 1)",
+        )
+        parser.add_argument(
+            "--max-request-bytes",
+            type=int,
+            help="answer requests larger than this with HTTP 413 (default: no limit)",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="seed for the generated data")
+
+    def handle(self, *args, **options):
+        project = FakeRedcapProject(
+            record_count=options["records"],
+            instrument_count=options["instruments"],
+            fields_per_instrument=options["fields"],
+            event_count=options["events"],
+            arm_count=options["arms"],
+            repeating_instrument_count=options["repeating"],
+            checkbox_rate=options["checkbox_rate"],
+            seed=options["seed"],
+        )
+        server = FakeRedcapServer(
+            project,
+            host=options["host"],
+            port=options["port"],
+            token=options["token"],
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            seed=options["seed"],
+            max_request_bytes=options["max_request_bytes"],
+        )
+        server.start()
+        self.stdout.write("Fake REDCap API running at {}".format(server.url))
+        self.stdout.write("Set RedcapApiUrl.url to this address. Press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
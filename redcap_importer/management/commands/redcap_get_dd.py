@@ -162,6 +162,8 @@ class Command(BaseCommand):
                 )
                 if entry['field_type'] == 'checkbox':
                     oField.is_many_to_many = True
+                if entry['field_type'] == 'text':
+                    oField.validation_type = entry['text_validation_type_or_show_slider_number']
                 oField.save()
             
     
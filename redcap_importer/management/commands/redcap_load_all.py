@@ -0,0 +1,133 @@
+import io
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import django
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from redcap_importer import models
+
+
+def setup_worker():
+    # on platforms that spawn worker processes instead of forking, Django has to be set up again
+    if not apps.ready:
+        django.setup()
+
+
+def load_connection(connection_name, load_options):
+    """Runs redcap_load_data for one connection in a worker process, returns (ok, output)"""
+    output = io.StringIO()
+    try:
+        call_command("redcap_load_data", connection_name, stdout=output, **load_options)
+        return True, output.getvalue()
+    except Exception:
+        return False, output.getvalue() + traceback.format_exc()
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs redcap_load_data for several connections (all of them by default) in parallel "
+        "worker processes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "connection_names",
+            nargs="*",
+            help="connections to load (default: every connection with a data dictionary)",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=4,
+            help="number of projects to load at the same time (default 4)",
+        )
+        parser.add_argument(
+            "--max-per-server",
+            type=int,
+            default=2,
+            help="number of projects on the same REDCap API URL to load at the same time "
+            "(default 2)",
+        )
+        # passed on to redcap_load_data
+        parser.add_argument("--chunk-size", type=int, default=1)
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--incremental", action="store_true")
+        parser.add_argument("--atomic", action="store_true")
+
+    def get_connections(self, connection_names):
+        if not connection_names:
+            qConnection = models.RedcapConnection.objects.filter(projectmetadata__isnull=False)
+            return list(qConnection.order_by("unique_name"))
+        connection_list = []
+        for connection_name in connection_names:
+            oConnection = models.RedcapConnection.objects.filter(
+                unique_name=connection_name
+            ).first()
+            if not oConnection:
+                raise CommandError("No connection named {}".format(connection_name))
+            if not oConnection.has_project():
+                raise CommandError(
+                    "No data dictionary for {}, run redcap_get_dd first".format(connection_name)
+                )
+            connection_list.append(oConnection)
+        return connection_list
+
+    def handle(self, *args, **options):
+        pending = self.get_connections(options["connection_names"])
+        load_options = {
+            "chunk_size": options["chunk_size"],
+            "workers": options["workers"],
+            "batch_size": options["batch_size"],
+            "incremental": options["incremental"],
+            "atomic": options["atomic"],
+        }
+        processes = max(options["processes"], 1)
+        max_per_server = max(options["max_per_server"], 1)
+        running = {}  # future -> connection
+        running_per_server = {}  # api url id -> number of loads running
+        failed = []
+
+        # each worker opens its own database connection, close ours so that forked workers don't
+        # inherit it. Nothing below uses the database until the workers are done.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=processes, initializer=setup_worker) as executor:
+            while pending or running:
+                # start whatever fits under both limits, in order
+                for oConnection in list(pending):
+                    if len(running) >= processes:
+                        break
+                    if running_per_server.get(oConnection.api_url_id, 0) >= max_per_server:
+                        continue
+                    pending.remove(oConnection)
+                    running_per_server[oConnection.api_url_id] = (
+                        running_per_server.get(oConnection.api_url_id, 0) + 1
+                    )
+                    future = executor.submit(load_connection, oConnection.unique_name, load_options)
+                    running[future] = oConnection
+                    self.stdout.write("started {}".format(oConnection.unique_name))
+
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    oConnection = running.pop(future)
+                    running_per_server[oConnection.api_url_id] -= 1
+                    try:
+                        ok, output = future.result()
+                    except Exception:
+                        # the worker process itself died
+                        ok, output = False, traceback.format_exc()
+                    self.stdout.write(output)
+                    if ok:
+                        self.stdout.write("finished {}".format(oConnection.unique_name))
+                    else:
+                        failed.append(oConnection.unique_name)
+                        self.stderr.write("FAILED {}".format(oConnection.unique_name))
+
+        if failed:
+            raise CommandError("{} failed to load: {}".format(len(failed), ", ".join(failed)))
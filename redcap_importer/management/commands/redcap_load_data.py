@@ -2,15 +2,27 @@ import json
 import datetime
 from io import StringIO
 import sys
+import threading
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand, CommandError
 from django.apps import apps
+from django.db import router, transaction
+from django.utils import timezone
 
 import requests
-from requests.adapters import HTTPAdapter
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from requests.utils import stream_decode_response_unicode
 from urllib3.util.retry import Retry
 
 from redcap_importer import models
+from redcap_importer.bulk_writer import BulkInstrumentWriter, RecordIdentityMap
+from redcap_importer.etl_metrics import EtlMetrics
+from redcap_importer.streaming import iter_json_array, iter_csv_records
+
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes of the response to parse at a time
 
 
 class Command(BaseCommand):
@@ -18,12 +30,13 @@ class Command(BaseCommand):
 
     def __init__(self, *args, **kwargs):
         self.query_count = 0
+        self.query_count_lock = threading.Lock()  # run_request may be called from worker threads
         self.log_comments = []  # a list of comments to save with the ETL log
         # make several attempts to recover from network errors
         # https://stackoverflow.com/questions/23013220/max-retries-exceeded-with-url-in-requests
         session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
+        self.retry = Retry(connect=3, backoff_factor=0.5)
+        adapter = HTTPAdapter(max_retries=self.retry)
         super().__init__(*args, **kwargs)
         session.mount("http://", adapter)
         session.mount("https://", adapter)
@@ -51,137 +64,461 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("connection_name")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1,
+            help="number of records to request from the REDCap API at a time (default 1)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of record chunks to fetch from the REDCap API concurrently (default 1). "
+            "This is also the maximum number of requests in flight at once.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="number of instrument records to buffer before writing them with one INSERT "
+            "per table (default 500)",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="only reload records created or modified in REDCap since the last load",
+        )
+        parser.add_argument(
+            "--atomic",
+            action="store_true",
+            help="load everything in a single database transaction, so readers never see a "
+            "partially loaded project and a failed load leaves the previous data in place",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="continue the most recent load of this connection from its last checkpoint "
+            "if it didn't finish, instead of starting over",
+        )
+        parser.add_argument(
+            "--stale-minutes",
+            type=int,
+            default=60,
+            help="with --resume, only take over a load that is still marked as started if its "
+            "log hasn't been updated for this many minutes (default 60), so that a load that is "
+            "still running isn't resumed alongside it",
+        )
 
     def run_request(self, content, oConnection, addl_options={}):
         addl_options["content"] = content
         addl_options["token"] = oConnection.get_api_token()
         addl_options["format"] = "json"
         addl_options["returnFormat"] = "json"
-        self.query_count += 1
-        return self.session.post(oConnection.api_url.url, addl_options).json()
+        with self.query_count_lock:
+            self.query_count += 1
+        with self.metrics.phase("network"):
+            response = self.session.post(oConnection.api_url.url, addl_options)
+        self.metrics.add_http(len(response.request.body or ""), len(response.content))
+        with self.metrics.phase("parse"):
+            return response.json()
+
+    def stream_request(self, content, oConnection, addl_options={}):
+        """
+        Like run_request(), but for requests that return a list: each entry is yielded as soon
+        as it has been received instead of holding the whole response in memory.
+
+        Records are downloaded in the connection's export_format, CSV rows are yielded as dicts
+        keyed by column name like the entries of a JSON export.
+        """
+        export_format = "json"
+        if content == "record":
+            export_format = oConnection.export_format
+        addl_options["content"] = content
+        addl_options["token"] = oConnection.get_api_token()
+        addl_options["format"] = export_format
+        addl_options["returnFormat"] = "json"
+        with self.query_count_lock:
+            self.query_count += 1
+        with self.metrics.phase("network"):
+            response = self.session.post(oConnection.api_url.url, addl_options, stream=True)
+        self.metrics.add_http(bytes_sent=len(response.request.body or ""))
+        with response:
+            if response.encoding is None:
+                response.encoding = "utf-8"
+            chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+            chunks = self.metrics.timed(self.metrics.count_received(chunks), "network")
+            chunks = stream_decode_response_unicode(chunks, response)
+            if export_format == models.RedcapConnection.ExportFormat.CSV:
+                yield from self.metrics.timed(iter_csv_records(chunks), "parse")
+            else:
+                yield from self.metrics.timed(iter_json_array(chunks), "parse")
+            # read what is left after the parser stopped (ex. a trailing newline) so that the
+            # connection goes back to the pool instead of being closed
+            for chunk in chunks:
+                pass
+
+    def iter_record_chunks(self, oConnection, pk_list, chunk_size, workers=1):
+        """
+        Yields the API response for each chunk of records in pk_list, in order.
+
+        With more than one worker, chunks are fetched on a thread pool that shares self.session,
+        but never more than `workers` requests are in flight at once. Responses are handed back
+        to the calling thread, so all database writes still happen in a single thread.
+        """
+        field_names, instrument_names = oConnection.get_record_export_names()
+        chunks = (
+            self.get_record_options(pk_list[i : i + chunk_size], instrument_names, field_names)
+            for i in range(0, len(pk_list), chunk_size)
+        )
+        if workers <= 1:
+            for record_options in chunks:
+                yield self.stream_request("record", oConnection, record_options)
+            return
+
+        if workers > DEFAULT_POOLSIZE:
+            # let every worker keep its own connection to the REDCap server open
+            adapter = HTTPAdapter(max_retries=self.retry, pool_maxsize=workers)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = collections.deque()
+            for record_options in chunks:
+                if len(in_flight) >= workers:
+                    yield in_flight.popleft().result()
+                in_flight.append(executor.submit(self.fetch_records, oConnection, record_options))
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    def fetch_records(self, oConnection, record_options):
+        """Downloads a whole chunk of records, for use on a worker thread"""
+        return list(self.stream_request("record", oConnection, record_options))
 
     def handle(self, *args, **options):
         connection_name = options["connection_name"]
         oConnection = models.RedcapConnection.objects.get(unique_name=connection_name)
         self.print_out(oConnection.projectmetadata, log=True)
         self.query_count = 0
+        self.metrics = EtlMetrics()
 
-        self.oEtlLog = models.EtlLog(
-            redcap_project=oConnection.unique_name,
-            start_date=datetime.datetime.now(),
-            status=models.EtlLog.STATUS_ETL_STARTED,
-        )
-        self.oEtlLog.save()
+        if options["resume"]:
+            if options["atomic"]:
+                raise CommandError("--resume can't be used with --atomic")
+            # carry on with the log of the unfinished load
+            self.oEtlLog = self.get_unfinished_log(oConnection, options["stale_minutes"])
+            self.oEtlLog.status = models.EtlLog.STATUS_ETL_STARTED
+            self.oEtlLog.save()
+            self.query_count = self.oEtlLog.query_count or 0
+            if self.oEtlLog.comment:
+                self.log_comments.insert(0, self.oEtlLog.comment)
+            self.print_out("resuming load started {}".format(self.oEtlLog.start_date), log=True)
+        else:
+            self.oEtlLog = models.EtlLog(
+                redcap_project=oConnection.unique_name,
+                start_date=datetime.datetime.now(),
+                status=models.EtlLog.STATUS_ETL_STARTED,
+                direction=models.EtlLog.Direction.DOWNLOAD,
+                atomic=options["atomic"],
+            )
+            self.oEtlLog.save()
         self.start_capture_stdout()
-
-        # delete existing data
-        app_name = oConnection.unique_name
-        pk_field = oConnection.projectmetadata.primary_key_field
-        ProjectRoot = apps.get_model(app_label=app_name, model_name="ProjectRoot")
-        for oRoot in ProjectRoot.objects.all():
-            oRoot.delete()
-
-        # get a list of all primary keys
-        response = self.run_request(
-            "record",
-            oConnection,
-            {
-                "fields": oConnection.projectmetadata.primary_key_field,
-            },
-        )
-        pk_list = []
-        for entry in response:
-            pk = entry[oConnection.projectmetadata.primary_key_field]
-            if not pk in pk_list:
-                pk_list.append(pk)
-
-        for pk in pk_list:
-            options = {"records[0]": pk}
-            instrument_names = oConnection.get_instrument_names()
-            if instrument_names:
-                for idx, instrument_name in enumerate(instrument_names):
-                    options["forms[{}]".format(idx)] = instrument_name
-            response = self.run_request("record", oConnection, options)
-            if oConnection.projectmetadata.is_longitudinal:
-                for entry in response:
-                    self.insert_longitudinal(entry, oConnection)
-            else:
-                for entry in response:
-                    self.insert_non_longitudinal(entry, oConnection)
-        oConnection.projectmetadata.date_last_downloaded_data = datetime.datetime.now()
-        oConnection.projectmetadata.save()
+        try:
+            with self.metrics.count_queries():
+                self.load(oConnection, options)
+        except Exception as e:
+            # keep what was measured so far, the load can still be resumed from the log
+            self.finish_capture_stdout()
+            self.log_comments.append("load failed: {}".format(e))
+            self.oEtlLog.status = self.oEtlLog.STATUS_ETL_FAILED
+            self.save_log()
+            raise
 
         instruments_loaded = oConnection.get_instrument_names()
         if instruments_loaded:
             instruments_loaded = "\n".join(instruments_loaded)
         self.finish_capture_stdout()
         self.oEtlLog.end_date = datetime.datetime.now()
-        self.oEtlLog.query_count = self.query_count
         self.oEtlLog.instruments_loaded = instruments_loaded
-        self.comment = "\n".join(self.log_comments)
         self.oEtlLog.status = self.oEtlLog.STATUS_ETL_COMPLETE
+        self.save_log()
+
+    def save_log(self):
+        self.oEtlLog.query_count = self.query_count
+        self.oEtlLog.comment = "\n".join(self.log_comments)
+        self.oEtlLog.metrics = json.dumps(self.metrics.as_dict())
         self.oEtlLog.save()
 
+    def get_unfinished_log(self, oConnection, stale_minutes):
+        """
+        Returns the log of the most recent load if it can be resumed: it failed, or it is still
+        marked as started but hasn't saved a checkpoint for stale_minutes (ex. the process was
+        killed).
+        """
+        oEtlLog = (
+            models.EtlLog.objects.filter(
+                redcap_project=oConnection.unique_name,
+                direction=models.EtlLog.Direction.DOWNLOAD,
+            )
+            .order_by("-start_date")
+            .first()
+        )
+        unfinished = (models.EtlLog.STATUS_ETL_STARTED, models.EtlLog.STATUS_ETL_FAILED)
+        if not oEtlLog or oEtlLog.status not in unfinished:
+            raise CommandError(
+                "The last load of {} finished, there is nothing to resume".format(
+                    oConnection.unique_name
+                )
+            )
+        if oEtlLog.atomic:
+            # nothing is committed until an atomic load is done, and it doesn't save checkpoints
+            # that would tell a load that is still running from one that was killed
+            raise CommandError(
+                "The last load of {} ran with --atomic, it kept none of its records. Run the load "
+                "again without --resume.".format(oConnection.unique_name)
+            )
+        if oEtlLog.status == models.EtlLog.STATUS_ETL_STARTED:
+            idle = timezone.now() - oEtlLog.modified
+            if idle < datetime.timedelta(minutes=stale_minutes):
+                raise CommandError(
+                    "The last load of {} may still be running, its log was updated {} minutes "
+                    "ago. Resume it once it has been idle for {} minutes.".format(
+                        oConnection.unique_name, int(idle.total_seconds() // 60), stale_minutes
+                    )
+                )
+        return oEtlLog
+
+    def get_resume_position(self, pk_list):
+        """Returns the index in pk_list of the first record after the last checkpoint"""
+        if self.oEtlLog.last_successful_record:
+            last_pk = json.loads(self.oEtlLog.last_successful_record)
+            if last_pk in pk_list:
+                return pk_list.index(last_pk) + 1
+        return min(self.oEtlLog.last_successful_record_number or 0, len(pk_list))
+
+    def save_checkpoint(self, records_done, last_pk):
+        self.oEtlLog.last_successful_record_number = records_done
+        self.oEtlLog.last_successful_record = json.dumps(last_pk)
+        self.oEtlLog.query_count = self.query_count
+        self.oEtlLog.save(
+            update_fields=[
+                "last_successful_record_number",
+                "last_successful_record",
+                "query_count",
+                "modified",
+            ]
+        )
+
+    def load(self, oConnection, options):
+        # anything changed in REDCap after the load started will be picked up by the next
+        # incremental load, a resumed load counts from when it was first started
+        load_started = self.oEtlLog.start_date
+        app_name = oConnection.unique_name
+        ProjectRoot = apps.get_model(app_label=app_name, model_name="ProjectRoot")
+
+        # get a list of all primary keys
+        pk_list = self.get_primary_keys(oConnection)
+
+        last_downloaded = oConnection.projectmetadata.date_last_downloaded_data
+        if options["atomic"]:
+            # readers keep seeing the previous data until everything has loaded, and a failed
+            # load leaves it untouched
+            load_transaction = transaction.atomic(using=router.db_for_write(ProjectRoot))
+        else:
+            load_transaction = contextlib.nullcontext()
+        records_done = 0
+        with load_transaction:
+            if options["resume"]:
+                # records up to the checkpoint were committed by the unfinished load, anything
+                # after it is deleted and loaded again
+                if options["incremental"] and last_downloaded:
+                    pk_list = self.get_primary_keys(oConnection, date_range_begin=last_downloaded)
+                pk_list = pk_list[self.get_resume_position(pk_list) :]
+                records_done = self.oEtlLog.last_successful_record_number or 0
+                self.print_out(
+                    "resuming after {} records, {} records left".format(records_done, len(pk_list)),
+                    log=True,
+                )
+                with self.metrics.phase("delete"):
+                    self.delete_records(ProjectRoot, pk_list)
+            elif options["incremental"] and last_downloaded:
+                # only reload records changed since the last load, and drop records that were
+                # deleted in REDCap
+                changed_pks = self.get_primary_keys(oConnection, date_range_begin=last_downloaded)
+                all_pks = set(pk_list)
+                with self.metrics.phase("delete"):
+                    existing_pks = ProjectRoot.objects.values_list("pk", flat=True)
+                    removed_pks = [pk for pk in existing_pks if pk not in all_pks]
+                    self.delete_records(ProjectRoot, changed_pks + removed_pks)
+                self.print_out(
+                    "incremental load: {} changed records, {} deleted records".format(
+                        len(changed_pks), len(removed_pks)
+                    ),
+                    log=True,
+                )
+                pk_list = changed_pks
+            else:
+                if options["incremental"]:
+                    self.print_out("no previous load found, loading all records", log=True)
+                # delete existing data, in atomic mode TRUNCATE would lock readers out for the
+                # whole load so DELETE instead
+                with self.metrics.phase("delete"):
+                    oConnection.projectmetadata.delete_loaded_data(truncate=not options["atomic"])
+
+            chunk_size = max(options["chunk_size"], 1)
+            workers = max(options["workers"], 1)
+            self.writer = BulkInstrumentWriter(
+                batch_size=max(options["batch_size"], 1), metrics=self.metrics
+            )
+            self.queued_rows = {}  # instrument name -> (REDCap rows, root or event for each row)
+            self.conversion_errors = {}  # (message, field name) -> [first value, count]
+            with self.metrics.phase("prepare"):
+                self.identity_map = RecordIdentityMap(oConnection.projectmetadata, self.writer)
+                self.load_instrument_metadata(oConnection)
+            chunk_responses = self.iter_record_chunks(oConnection, pk_list, chunk_size, workers)
+            for idx, response in enumerate(chunk_responses):
+                pk_chunk = pk_list[idx * chunk_size : (idx + 1) * chunk_size]
+                # each chunk is committed on its own and checkpointed so that a failed load can
+                # be resumed, unless the whole load is already in one transaction
+                if options["atomic"]:
+                    chunk_transaction = contextlib.nullcontext()
+                else:
+                    chunk_transaction = transaction.atomic(using=router.db_for_write(ProjectRoot))
+                with chunk_transaction:
+                    # building records from the response, reading the response and writing
+                    # records are counted as separate phases
+                    with self.metrics.phase("convert"):
+                        if oConnection.projectmetadata.is_longitudinal:
+                            for entry in response:
+                                self.insert_longitudinal(entry, oConnection)
+                        else:
+                            for entry in response:
+                                self.insert_non_longitudinal(entry, oConnection)
+                        # the rows for each instrument are converted together, a column at a time
+                        self.create_queued_records()
+                    self.writer.flush()
+                records_done += len(pk_chunk)
+                if not options["atomic"]:
+                    # in an atomic load the checkpoint would be rolled back with the records
+                    self.save_checkpoint(records_done, pk_chunk[-1])
+        self.report_conversion_errors()
+        oConnection.projectmetadata.date_last_downloaded_data = load_started
+        oConnection.projectmetadata.save()
+
+    def get_primary_keys(self, oConnection, date_range_begin=None):
+        """
+        Returns the primary key of every record in the project, or only of records created or
+        modified since date_range_begin if set.
+        """
+        pk_field = oConnection.projectmetadata.primary_key_field
+        record_options = {"fields": pk_field}
+        if date_range_begin:
+            if timezone.is_aware(date_range_begin):
+                # REDCap expects the date in the server's local time
+                date_range_begin = timezone.localtime(date_range_begin)
+            record_options["dateRangeBegin"] = date_range_begin.strftime("%Y-%m-%d %H:%M:%S")
+        # REDCap returns a row for every event and repeat instance, dict keys keep the first
+        # occurrence of each primary key in order
+        pk_list = {}
+        for entry in self.stream_request("record", oConnection, record_options):
+            pk_list[entry[pk_field]] = None
+        return list(pk_list)
+
+    def delete_records(self, ProjectRoot, pk_list, batch_size=500):
+        """Deletes the given roots along with their events and instruments"""
+        for i in range(0, len(pk_list), batch_size):
+            ProjectRoot.objects.filter(pk__in=pk_list[i : i + batch_size]).delete()
+
+    def load_instrument_metadata(self, oConnection):
+        """
+        Keeps one InstrumentMetadata per instrument for the whole load, so each instrument's
+        load plan is compiled once and no metadata queries are needed while inserting rows.
+        """
+        self.instruments = {}
+        for oInstrument in oConnection.projectmetadata.instrumentmetadata_set.all():
+            self.instruments[oInstrument.unique_name] = oInstrument
+
+    def get_record_options(self, pk_chunk, instrument_names=None, field_names=None):
+        """Builds the API options to export every record in pk_chunk with a single request"""
+        options = {}
+        for idx, pk in enumerate(pk_chunk):
+            options["records[{}]".format(idx)] = pk
+        if instrument_names:
+            for idx, instrument_name in enumerate(instrument_names):
+                options["forms[{}]".format(idx)] = instrument_name
+        if field_names:
+            for idx, field_name in enumerate(field_names):
+                options["fields[{}]".format(idx)] = field_name
+        return options
+
+    def queue_row(self, instrument_name, entry, oParent):
+        """Holds a REDCap row for an instrument until create_queued_records() is called"""
+        entries, parents = self.queued_rows.setdefault(instrument_name, ([], []))
+        entries.append(entry)
+        parents.append(oParent)
+
+    def create_queued_records(self):
+        """Converts the queued rows one instrument at a time and hands the records to the writer"""
+        errors = []
+        for instrument_name, (entries, parents) in self.queued_rows.items():
+            plan = self.instruments[instrument_name].get_load_plan()
+            plan.create_records(entries, parents, writer=self.writer, errors=errors)
+        self.queued_rows = {}
+        for message, field_name, value in errors:
+            # only keep the first value and a count for each problem
+            key = (message, field_name)
+            if key not in self.conversion_errors:
+                self.conversion_errors[key] = [value, 0]
+            self.conversion_errors[key][1] += 1
+
+    def report_conversion_errors(self):
+        for (message, field_name), (value, count) in self.conversion_errors.items():
+            line = message.format(field_name, value)
+            if count > 1:
+                line += " ({} values)".format(count)
+            self.print_out(line, log=True)
+
     def insert_non_longitudinal(self, entry, oConnection):
         #         print(entry[pk_field], 'not long')
         #         print(entry['redcap_repeat_instrument'])
         #         print(entry['redcap_repeat_instance'])
         #         print()
-        app_name = oConnection.unique_name
         pk_field = oConnection.projectmetadata.primary_key_field
 
         # get or create root
-        ProjectRoot = apps.get_model(app_label=app_name, model_name="ProjectRoot")
-        oRoot, created = ProjectRoot.objects.get_or_create(pk=entry[pk_field])
-        # TO DO: set pk_label by looking up
+        oRoot = self.identity_map.get_root(entry[pk_field])
         if "redcap_repeat_instrument" in entry and entry["redcap_repeat_instrument"]:
             # repeat instrument, have 1 instrument to load
             instrument_name = entry["redcap_repeat_instrument"]
             if not oConnection.check_include_instrument(instrument_name):
                 return
-            oInstrumentMetadata = models.InstrumentMetadata.objects.get(
-                project=oConnection.projectmetadata, unique_name=instrument_name
-            )
-            oInstrumentMetadata.create_instrument_record(entry, oRoot=oRoot)
+            self.queue_row(instrument_name, entry, oRoot)
         else:
             # base_record, load all non-repeating instruments (verify not empty)
-            qInstrument = oConnection.projectmetadata.instrumentmetadata_set.exclude(
-                repeatable=True
-            )
-            for oInstrument in qInstrument:
+            for oInstrument in self.instruments.values():
+                if oInstrument.repeatable:
+                    continue
                 if not oConnection.check_include_instrument(oInstrument.unique_name):
                     continue
-                oInstrument.create_instrument_record(entry, oRoot=oRoot)
+                self.queue_row(oInstrument.unique_name, entry, oRoot)
 
     def insert_longitudinal(self, entry, oConnection):
-        app_name = oConnection.unique_name
         pk_field = oConnection.projectmetadata.primary_key_field
 
-        # get or create root
-        ProjectRoot = apps.get_model(app_label=app_name, model_name="ProjectRoot")
-        oRoot, created = ProjectRoot.objects.get_or_create(pk=entry[pk_field])
-        # TO DO: set pk_label by looking up
-
-        oEventMetadata = models.EventMetadata.objects.get(
-            project=oConnection.projectmetadata, unique_name=entry["redcap_event_name"]
-        )
-        oEvent = oEventMetadata.get_or_create_event_record(oRoot)
+        # get or create root and event
+        oRoot = self.identity_map.get_root(entry[pk_field])
+        oEvent = self.identity_map.get_event(oRoot, entry["redcap_event_name"])
 
         if "redcap_repeat_instrument" in entry and entry["redcap_repeat_instrument"]:
             # repeat instrument, have 1 instrument to load
             instrument_name = entry["redcap_repeat_instrument"]
             if not oConnection.check_include_instrument(instrument_name):
                 return
-            oInstrumentMetadata = models.InstrumentMetadata.objects.get(
-                project=oConnection.projectmetadata, unique_name=instrument_name
-            )
-            oInstrumentMetadata.create_instrument_record(entry, oEvent=oEvent)
+            self.queue_row(instrument_name, entry, oEvent)
         else:
             # base_record, load all non-repeating instruments (verify not empty)
-            qInstrument = oConnection.projectmetadata.instrumentmetadata_set.exclude(
-                repeatable=True
-            )
-            for oInstrument in qInstrument:
+            for oInstrument in self.instruments.values():
+                if oInstrument.repeatable:
+                    continue
                 if not oConnection.check_include_instrument(oInstrument.unique_name):
                     continue
-                oInstrument.create_instrument_record(entry, oEvent=oEvent)
+                self.queue_row(oInstrument.unique_name, entry, oEvent)
@@ -37,6 +37,7 @@ class Command(BaseCommand):
         models.ArmMetadata.objects.all().delete()
         models.ProjectMetadata.objects.all().delete()
         models.IncludeInstrument.objects.all().delete()
+        models.IncludeField.objects.all().delete()
         models.RedcapConnection.objects.all().delete()
         models.RedcapApiUrl.objects.all().delete()
 
@@ -64,14 +64,19 @@ class Command(BaseCommand):
         else:
             self.output.append("    project_root = models.ForeignKey('ProjectRoot', on_delete=models.CASCADE)")
         self.output.append("    redcap_repeat_instance = models.IntegerField(blank=True, null=True)")
-        for oField in oInstrument.fieldmetadata_set.exclude(is_many_to_many=True):
+        self.output.append("    redcap_form_status = models.IntegerField(blank=True, null=True)")
+        for oField in oInstrument.get_fields_to_load():
+            if oField.is_many_to_many:
+                continue
             self.output.append("    {} = models.{}(blank=True, null=True)".format(oField.get_django_field_name(), oField.django_data_type))
             if oField.get_display_lookup():
                 self.output.append( "    {}_display_value = models.TextField(blank=True, null=True)".format( oField.get_django_field_name() ) )
         self.print_blank_lines(2)
         
     def print_lookup_tables(self, oInstrument):
-        for oField in oInstrument.fieldmetadata_set.filter(is_many_to_many=True):
+        for oField in oInstrument.get_fields_to_load():
+            if not oField.is_many_to_many:
+                continue
             self.output.append("class {}_{}_lookup(models.Model):".format(
                 oInstrument.get_django_model_name(), oField.get_django_field_name()
             ))
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redcap_importer', '0011_auto_20231106_1225'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='etllog',
+            name='metrics',
+            field=models.TextField(blank=True, help_text='JSON with the time spent in each phase, rows written per model, SQL statements and HTTP bytes', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redcap_importer', '0012_etllog_metrics'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='etllog',
+            name='status',
+            field=models.CharField(choices=[('ETL started', 'ETL started'), ('ETL completed', 'ETL completed'), ('ETL failed', 'ETL failed'), ('upload started', 'upload started'), ('upload failed', 'upload failed'), ('upload complete', 'upload complete')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redcap_importer', '0013_alter_etllog_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fieldmetadata',
+            name='validation_type',
+            field=models.CharField(blank=True, help_text='REDCap validation type of text fields, ex. date_mdy, integer', max_length=120, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redcap_importer', '0014_fieldmetadata_validation_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='redcapconnection',
+            name='export_format',
+            field=models.CharField(choices=[('json', 'JSON'), ('csv', 'CSV')], default='json', help_text="Format redcap_load_data downloads records in. CSV doesn't repeat the field names on every row, which makes the download of wide projects a lot smaller.", max_length=4),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.10 on 2026-10-18 15:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redcap_importer', '0015_redcapconnection_export_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IncludeField',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field_name', models.CharField(help_text='unique_name of the field to include', max_length=255)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='redcap_importer.redcapconnection')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='redcapconnection',
+            name='partial_load',
+            field=models.BooleanField(default=False, help_text='If True, only instruments in IncludeInstrument list will be loaded. If any of their fields are in the IncludeField list, only those fields will be loaded.'),
+        ),
+    ]
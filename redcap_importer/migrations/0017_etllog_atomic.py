@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redcap_importer', '0016_includefield'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='etllog',
+            name='atomic',
+            field=models.BooleanField(default=False, help_text='loaded in a single transaction with --atomic, a failed load kept nothing to resume'),
+        ),
+    ]
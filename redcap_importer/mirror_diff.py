@@ -0,0 +1,202 @@
+import hashlib
+
+from redcap_importer.load_plan import to_form_status
+
+KEY_COLUMNS = ("redcap_event_name", "redcap_repeat_instrument", "redcap_repeat_instance")
+
+# stands in for a value that can't be compared with the local copy, so it is always sent
+NOT_COMPARABLE = object()
+
+
+class MirrorDiff:
+    """
+    Compares records about to be uploaded to REDCap with the local copy of the project loaded by
+    redcap_load_data, so values REDCap already holds aren't sent again.
+
+    How to use:
+    - create one per upload with the RedcapConnection, after the project has been loaded
+    - filter_batch(records) returns the records with unchanged instruments left out
+        - records are compared an instrument at a time: if every value of an instrument (for
+          the record, event and repeat instance) matches the local copy, its columns are
+          dropped, otherwise they are all sent
+        - records with nothing left to send are left out entirely
+        - blank columns of other instruments on a repeat instance row are left out
+        - form status columns ([instrument]_complete) are compared like the instrument's values
+          with the status stored in redcap_form_status. Models generated before that column was
+          added don't have it, so their statuses are always sent unless blank
+        - columns the local copy doesn't have are always sent, with the record's key columns.
+          These include instruments or fields not loaded with partial_load
+    - the local copy is only as recent as the last load, a value changed in REDCap since then
+      won't be set back if the upload matches the old value
+    """
+
+    def __init__(self, oConnection):
+        oProject = oConnection.projectmetadata
+        self.pk_field = oProject.primary_key_field
+        self.is_longitudinal = oProject.is_longitudinal
+        self.plans = {}  # instrument name: InstrumentLoadPlan
+        self.column_fields = {}  # export column: (instrument name, FieldLoadPlan)
+        self.status_columns = {}  # [instrument]_complete column: instrument name
+        qInstrument = oProject.instrumentmetadata_set.prefetch_related("fieldmetadata_set")
+        for oInstrument in qInstrument:
+            if not oInstrument.instrument_will_load():
+                continue
+            plan = oInstrument.get_load_plan()
+            self.plans[oInstrument.unique_name] = plan
+            self.status_columns[oInstrument.unique_name + "_complete"] = oInstrument.unique_name
+            for field in plan.fields:
+                for column, empty_value in field.get_data_columns():
+                    self.column_fields[column] = (oInstrument.unique_name, field)
+        self.key_columns = frozenset((self.pk_field,) + KEY_COLUMNS)
+
+    def get_row_key(self, record):
+        """(record id, event name, repeat instance) of an export row, as the local copy has it"""
+        instance = record.get("redcap_repeat_instance", "")
+        event_name = record.get("redcap_event_name", "") if self.is_longitudinal else ""
+        return (
+            str(record[self.pk_field]),
+            event_name or "",
+            int(instance) if instance not in ("", None) else None,
+        )
+
+    def group_columns(self, record):
+        """
+        Returns ({instrument name: [columns to compare]}, {instrument name: [blank status
+        columns]}, [blank columns]) for the columns of an export row that the local copy can
+        account for. Status columns are compared with the instrument's values, except on models
+        without redcap_form_status, where only blank ones are included (as status columns).
+        """
+        repeat_instrument = record.get("redcap_repeat_instrument", "")
+        groups = {}
+        status_columns = {}
+        blank_columns = []
+        for column in record:
+            if column in self.key_columns:
+                continue
+            if column in self.status_columns:
+                instrument_name = self.status_columns[column]
+                if repeat_instrument and instrument_name != repeat_instrument:
+                    if record[column] in ("", None):
+                        blank_columns.append(column)
+                elif self.plans[instrument_name].has_form_status:
+                    groups.setdefault(instrument_name, []).append(column)
+                elif record[column] in ("", None):
+                    status_columns.setdefault(instrument_name, []).append(column)
+                continue
+            if column not in self.column_fields:
+                continue
+            instrument_name, field = self.column_fields[column]
+            if repeat_instrument and instrument_name != repeat_instrument:
+                # only the repeating instrument is stored for a repeat instance
+                if self.normalize(column, record[column]) in (None, False):
+                    blank_columns.append(column)
+                continue
+            groups.setdefault(instrument_name, []).append(column)
+        return groups, status_columns, blank_columns
+
+    def filter_batch(self, records):
+        """Returns the records with unchanged instruments left out, see the class docstring"""
+        grouped = [(record, self.group_columns(record)) for record in records]
+        record_ids = {str(record[self.pk_field]) for record in records}
+        instrument_names = {name for record, (groups, _, _) in grouped for name in groups}
+        mirrors = {name: self.get_mirror_rows(name, record_ids) for name in instrument_names}
+
+        filtered = []
+        for record, (groups, status_columns, blank_columns) in grouped:
+            key = self.get_row_key(record)
+            unchanged = set(blank_columns)
+            for instrument_name, columns in groups.items():
+                mirror_row = mirrors[instrument_name].get(key, {})
+                outgoing = self.hash_values(
+                    self.normalize(column, record[column]) for column in columns
+                )
+                mirrored = self.hash_values(
+                    self.get_mirror_value(column, mirror_row) for column in columns
+                )
+                if outgoing is not None and outgoing == mirrored:
+                    unchanged.update(columns)
+                    unchanged.update(status_columns.get(instrument_name, []))
+            if not unchanged:
+                filtered.append(record)
+                continue
+            remaining = {
+                column: value for column, value in record.items() if column not in unchanged
+            }
+            if set(remaining).issubset(self.key_columns):
+                continue  # nothing left to send
+            filtered.append(remaining)
+        return filtered
+
+    def hash_values(self, values):
+        values = tuple(values)
+        if any(value is NOT_COMPARABLE for value in values):
+            return None
+        return hashlib.sha1(repr(values).encode("utf-8")).digest()
+
+    def normalize(self, column, value):
+        """Converts an outgoing value the way redcap_load_data would have stored it"""
+        if column in self.status_columns:
+            status = to_form_status(value)
+            if status is None and value not in ("", None):
+                return NOT_COMPARABLE
+            return status
+        instrument_name, field = self.column_fields[column]
+        if field.is_many_to_many:
+            return value in ("1", 1, True)
+        if value is None or value == "":
+            return None
+        if not field.converter:
+            return str(value)
+        try:
+            return field.converter(value)
+        except (ValueError, TypeError):
+            return NOT_COMPARABLE
+
+    def get_mirror_value(self, column, mirror_row):
+        if column in self.status_columns:
+            return mirror_row.get("redcap_form_status")
+        instrument_name, field = self.column_fields[column]
+        if field.is_many_to_many:
+            return column in mirror_row.get("checked", ())
+        return mirror_row.get(field.django_field_name)
+
+    def get_mirror_rows(self, instrument_name, record_ids):
+        """
+        Returns {row key: values} from the local copy of an instrument for the given records.
+        Checkbox columns that are checked are listed under "checked".
+        """
+        plan = self.plans[instrument_name]
+        if self.is_longitudinal:
+            record_path = "redcap_event__project_root_id"
+            event_path = "redcap_event__event_unique_name"
+        else:
+            record_path = "project_root_id"
+            event_path = None
+        names = ["id", record_path, "redcap_repeat_instance"]
+        names += [field.django_field_name for field in plan.value_fields]
+        if plan.has_form_status:
+            names.append("redcap_form_status")
+        if event_path:
+            names.append(event_path)
+        qInstrument = plan.InstrumentModel.objects.filter(**{record_path + "__in": record_ids})
+
+        rows = {}
+        rows_by_id = {}
+        for values in qInstrument.values(*names):
+            key = (
+                str(values[record_path]),
+                values[event_path] if event_path else "",
+                values["redcap_repeat_instance"],
+            )
+            values["checked"] = set()
+            rows.setdefault(key, values)
+            rows_by_id[values["id"]] = values
+        for field in plan.checkbox_fields:
+            columns = {key: column for key, column, display_value in field.checkbox_columns}
+            qLookup = field.LookupModel.objects.filter(
+                **{field.lookup_fk_name + "_id__in": list(rows_by_id)}
+            ).values_list(field.lookup_fk_name + "_id", field.django_field_name)
+            for instrument_id, choice in qLookup:
+                if choice in columns:
+                    rows_by_id[instrument_id]["checked"].add(columns[choice])
+        return rows
@@ -1,13 +1,16 @@
 import json
 import collections
 import datetime
-from dateutil.parser import parse
 
-from django.db import models
+from django.db import models, connections, router, transaction
 from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.color import no_style
 
 from django.conf import settings
 
+from .load_plan import InstrumentLoadPlan, FieldLoadPlan, columns_have_data
+
 
 class RedcapApiUrl(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -25,6 +28,10 @@ class RedcapApiUrl(models.Model):
 
 
 class RedcapConnection(models.Model):
+    class ExportFormat(models.TextChoices):
+        JSON = "json", "JSON"
+        CSV = "csv", "CSV"
+
     unique_name = models.SlugField(
         unique=True,
         help_text="A unique reference for this connection and associated Django app."
@@ -34,9 +41,17 @@ class RedcapConnection(models.Model):
     )
     partial_load = models.BooleanField(
         default=False,
-        help_text="If True, only instruments in IncludeInstrument list will be loaded.",
+        help_text="If True, only instruments in IncludeInstrument list will be loaded. If any "
+        "of their fields are in the IncludeField list, only those fields will be loaded.",
     )
     api_url = models.ForeignKey("RedcapApiUrl", on_delete=models.PROTECT, verbose_name="API URL")
+    export_format = models.CharField(
+        max_length=4,
+        choices=ExportFormat.choices,
+        default=ExportFormat.JSON,
+        help_text="Format redcap_load_data downloads records in. CSV doesn't repeat the field "
+        "names on every row, which makes the download of wide projects a lot smaller.",
+    )
 
     def __str__(self):
         return self.unique_name
@@ -58,21 +73,75 @@ class RedcapConnection(models.Model):
     def has_project(self):
         return hasattr(self, "projectmetadata")
 
+    def get_include_instrument_names(self):
+        """
+        Returns the instrument names from IncludeInstrument, in order. They are only queried once
+        for each RedcapConnection object (or taken from prefetch_related("includeinstrument_set")),
+        so hold on to the same object for the length of a load or request.
+        """
+        if not hasattr(self, "_include_instrument_names"):
+            self._include_instrument_names = [
+                oInclude.instrument_name for oInclude in self.includeinstrument_set.all()
+            ]
+            self._include_instrument_set = frozenset(self._include_instrument_names)
+        return self._include_instrument_names
+
+    def get_include_instrument_set(self):
+        self.get_include_instrument_names()
+        return self._include_instrument_set
+
     def check_include_instrument(self, instrument_name):
         if not self.partial_load:
             return True
-        oInclude = IncludeInstrument.objects.filter(
-            connection=self, instrument_name=instrument_name
-        ).first()
-        return True if oInclude else False
+        return instrument_name in self.get_include_instrument_set()
 
     def get_instrument_names(self):
         if not self.partial_load:
             return None
-        response = []
-        for oInclude in IncludeInstrument.objects.filter(connection=self):
-            response.append(oInclude.instrument_name)
-        return response
+        return list(self.get_include_instrument_names())
+
+    def get_include_field_set(self):
+        """
+        Returns the field names from IncludeField, queried once for each RedcapConnection object
+        like get_include_instrument_names().
+        """
+        if not hasattr(self, "_include_field_set"):
+            self._include_field_set = frozenset(
+                oInclude.field_name for oInclude in self.includefield_set.all()
+            )
+        return self._include_field_set
+
+    def get_record_export_names(self):
+        """
+        Returns (field names, instrument names) to export records with, each None if not
+        restricted. Included instruments with fields in IncludeField are exported field by
+        field instead of as a whole instrument, so only those fields are downloaded.
+        """
+        if not self.partial_load:
+            return None, None
+        instrument_names = self.get_instrument_names()
+        if not self.get_include_field_set():
+            return None, instrument_names
+        qField = FieldMetadata.objects.filter(
+            instrument__project__connection=self,
+            instrument__unique_name__in=instrument_names,
+            unique_name__in=self.get_include_field_set(),
+        )
+        field_names = []
+        field_instrument_names = set()
+        for field_name, instrument_name in qField.values_list(
+            "unique_name", "instrument__unique_name"
+        ):
+            field_names.append(field_name)
+            field_instrument_names.add(instrument_name)
+        if not field_names:
+            return None, instrument_names
+        # REDCap only returns the record id along with the named fields if it is asked for
+        primary_key_field = self.projectmetadata.primary_key_field
+        if primary_key_field not in field_names:
+            field_names.insert(0, primary_key_field)
+        instrument_names = [name for name in instrument_names if name not in field_instrument_names]
+        return field_names, instrument_names
 
 
 class IncludeInstrument(models.Model):
@@ -85,6 +154,14 @@ class IncludeInstrument(models.Model):
         return "{}.{}".format(self.connection.unique_name, self.instrument_name)
 
 
+class IncludeField(models.Model):
+    connection = models.ForeignKey("RedcapConnection", on_delete=models.CASCADE)
+    field_name = models.CharField(max_length=255, help_text="unique_name of the field to include")
+
+    def __str__(self):
+        return "{}.{}".format(self.connection.unique_name, self.field_name)
+
+
 class ProjectMetadata(models.Model):
     connection = models.OneToOneField("RedcapConnection", on_delete=models.CASCADE)
     project_title = models.CharField(max_length=255)
@@ -110,6 +187,60 @@ class ProjectMetadata(models.Model):
             return None
         return RootModel
 
+    def get_generated_models(self):
+        """
+        Returns the models in this project's Django app (ProjectRoot, RedcapEvent, instruments and
+        lookup tables), ordered so that each model comes before any model it points to.
+        """
+        try:
+            app_config = apps.get_app_config(self.connection.unique_name)
+        except LookupError:
+            return []
+        remaining = list(app_config.get_models())
+        ordered = []
+        while remaining:
+            referenced = set()
+            for Model in remaining:
+                for field in Model._meta.concrete_fields:
+                    if field.is_relation and field.related_model is not Model:
+                        referenced.add(field.related_model)
+            next_models = [Model for Model in remaining if Model not in referenced]
+            if not next_models:
+                # circular foreign keys, the database will have to sort it out
+                next_models = remaining
+            ordered.extend(next_models)
+            remaining = [Model for Model in remaining if Model not in next_models]
+        return ordered
+
+    def delete_loaded_data(self, truncate=True):
+        """
+        Empties every table in this project's Django app in one transaction, without loading
+        any rows into memory the way ProjectRoot.delete() cascades do.
+
+        With truncate=True tables are cleared the way Django's flush command does it, which is
+        TRUNCATE on backends that support it. TRUNCATE locks out readers until the transaction
+        ends, so use truncate=False to DELETE instead when readers should keep seeing the old
+        rows until commit.
+
+        TRUNCATE can only be rolled back on backends with transactional DDL (ex. PostgreSQL). On
+        the others (ex. MySQL, where it commits straight away) tables are always cleared with
+        DELETE, so that the transaction holds.
+        """
+        Models = self.get_generated_models()
+        if not Models:
+            return
+        db = router.db_for_write(Models[0])
+        connection = connections[db]
+        tables = [Model._meta.db_table for Model in Models]
+        with transaction.atomic(using=db):
+            with connection.cursor() as cursor:
+                if truncate and connection.features.can_rollback_ddl:
+                    for sql in connection.ops.sql_flush(no_style(), tables):
+                        cursor.execute(sql)
+                else:
+                    for table in tables:
+                        cursor.execute("DELETE FROM {}".format(connection.ops.quote_name(table)))
+
     def get_project_queryset_or_collection(self, data_source):
         ProjectRoot = self.get_actual_project_root_model()
         return ProjectRoot.objects.all()
@@ -253,58 +384,47 @@ class InstrumentMetadata(models.Model):
             return MyModel.objects.all().count()
         return 0
 
+    def get_load_plan(self):
+        """
+        Returns an InstrumentLoadPlan compiled from this instrument and its fields. The plan is
+        cached on this object, so keep hold of the same InstrumentMetadata for the whole load.
+        """
+        if not hasattr(self, "_load_plan"):
+            self._load_plan = InstrumentLoadPlan(self)
+        return self._load_plan
+
+    def get_fields_to_load(self):
+        """
+        Returns the FieldMetadata to load and write models for. With partial_load, if any of this
+        instrument's fields are in IncludeField only those are returned, otherwise all of them.
+        """
+        fields = list(self.fieldmetadata_set.all())
+        oConnection = self.project.connection
+        if not oConnection.partial_load:
+            return fields
+        include_fields = oConnection.get_include_field_set()
+        return [oField for oField in fields if oField.unique_name in include_fields] or fields
+
     def create_instrument_dict(self, entry):
-        response = {}
-        data_exists = False
-        for oField in self.fieldmetadata_set.all():
-            if oField.check_value_exists(entry):
-                data_exists = True
-        if not data_exists:
+        plan = self.get_load_plan()
+        if not plan.has_data(entry):
             return None
-        for oField in self.fieldmetadata_set.all():
-            if oField.unique_name in entry:
-                value = entry[oField.unique_name]
+        response = {}
+        for field in plan.fields:
+            if field.unique_name in entry:
+                value = entry[field.unique_name]
                 if isinstance(value, datetime.date):
-                    value = datetime.combine(value, datetime.min.time())
-                response[oField.get_django_field_name()] = value
+                    value = datetime.datetime.combine(value, datetime.datetime.min.time())
+                response[field.django_field_name] = value
         return response
 
-    def create_instrument_record(self, entry, oRoot=None, oEvent=None):
+    def create_instrument_record(self, entry, oRoot=None, oEvent=None, writer=None):
         # EITHER OROOT OR OEVENT SHOULD BE SET, NOT BOTH
-        # go ahead and return none if no data
-        data_exists = False
-        for oField in self.fieldmetadata_set.all():
-            if oField.check_value_exists(entry):
-                data_exists = True
-        if not data_exists:
-            return None
-        app_name = self.project.connection.unique_name
-        ActualInstrument = apps.get_model(
-            app_label=app_name, model_name=self.get_django_model_name()
-        )
-        oActualInstrument = ActualInstrument()
-        if oRoot:
-            oActualInstrument.project_root = oRoot
-        else:
-            oActualInstrument.redcap_event = oEvent
-        if "redcap_repeat_instance" in entry and entry["redcap_repeat_instance"] != "":
-            oActualInstrument.redcap_repeat_instance = int(entry["redcap_repeat_instance"])
-        # set metadata values like redcap repeat instance
-        oActualInstrument.save()
-        for oField in self.fieldmetadata_set.all():
-            oField.add_value_to_instrument(oActualInstrument, entry)
-        oActualInstrument.save()
-        return oActualInstrument
+        # if a BulkInstrumentWriter is given, the record is handed to it unsaved instead
+        return self.get_load_plan().create_record(entry, oRoot=oRoot, oEvent=oEvent, writer=writer)
 
     def instrument_will_load(self):
-        oConnection = self.project.connection
-        if not oConnection.partial_load:
-            return True
-        oInclude = IncludeInstrument.objects.filter(
-            connection=oConnection,
-            instrument_name=self.unique_name,
-        ).first()
-        return True if oInclude else False
+        return self.project.connection.check_include_instrument(self.unique_name)
 
 
 class FieldMetadata(models.Model):
@@ -321,6 +441,12 @@ class FieldMetadata(models.Model):
         help_text="If set, creates a second field [field_name]_display and attempts to populate it with lookup val",
     )
     is_many_to_many = models.BooleanField(default=False)
+    validation_type = models.CharField(
+        max_length=120,
+        blank=True,
+        null=True,
+        help_text="REDCap validation type of text fields, ex. date_mdy, integer",
+    )
 
     def __str__(self):
         return "FIELD: {}".format(self.unique_name)
@@ -337,17 +463,19 @@ class FieldMetadata(models.Model):
         return self.django_field_name if self.django_field_name else self.unique_name
 
     def get_field_values(self):
+        # fields left out with IncludeField (or not loaded yet) have no values to show
         InstrumentModel = self.instrument.get_actual_instrument_model()
         if self.is_many_to_many:
-            app_name = self.instrument.project.connection.unique_name
-            model_name = "{}_{}_lookup".format(
-                self.instrument.get_django_model_name(), self.get_django_field_name()
-            )
-            LookupModel = apps.get_model(app_label=app_name, model_name=model_name)
+            try:
+                LookupModel = self.get_actual_lookup_model()
+            except LookupError:
+                return []
             qField = LookupModel.objects.all().values_list(
                 self.get_django_field_name() + "_display_value", flat=True
             )
 
+        elif not InstrumentModel or not self.is_in_model(InstrumentModel):
+            return []
         elif self.get_display_lookup():
             qField = InstrumentModel.objects.all().values_list(
                 self.get_django_field_name() + "_display_value", flat=True
@@ -358,6 +486,13 @@ class FieldMetadata(models.Model):
             )
         return list(qField)
 
+    def is_in_model(self, InstrumentModel):
+        try:
+            InstrumentModel._meta.get_field(self.get_django_field_name())
+        except FieldDoesNotExist:
+            return False
+        return True
+
     def get_stats(self):
         values = self.get_field_values()
 
@@ -404,112 +539,37 @@ class FieldMetadata(models.Model):
             return 0
         return LookupModel.objects.all().count()
 
+    def get_actual_lookup_model(self):
+        """The lookup table model for a many to many (checkbox) field"""
+        app_name = self.instrument.project.connection.unique_name
+        model_name = "{}_{}_lookup".format(
+            self.instrument.get_django_model_name(), self.get_django_field_name()
+        )
+        return apps.get_model(app_label=app_name, model_name=model_name)
+
+    def get_load_plan(self):
+        """Returns a FieldLoadPlan compiled from this field, cached on this object"""
+        if not hasattr(self, "_load_plan"):
+            self._load_plan = FieldLoadPlan(self)
+        return self._load_plan
+
     def check_value_exists(self, entry):
-        if self.is_many_to_many:
-            for key, field_name in self._get_many_to_many_redcap_fields().items():
-                if field_name != "":
-                    return True
-            return False
-        else:
-            if not self.unique_name in entry:
-                # print('field missing from data: {}'.format(self.unique_name))
-                # there are fields that don't return a value because they are just a label or something
-                return False
-            value = entry[self.unique_name]
-            return False if value == "" else True
-
-    def add_value_to_instrument(self, oInstrument, entry):
-        if self.is_many_to_many:
-            field_names = self._get_many_to_many_redcap_fields()
-            for key, field_name in field_names.items():
-                if entry[field_name] == "1":
-                    app_name = self.instrument.project.connection.unique_name
-                    model_name = "{}_{}_lookup".format(
-                        self.instrument.get_django_model_name(), self.get_django_field_name()
-                    )
-                    LookupModel = apps.get_model(app_label=app_name, model_name=model_name)
-                    display_value = self.get_display_lookup()[key]
-                    args = {
-                        self.instrument.get_django_model_name(): oInstrument,
-                        self.get_django_field_name(): key,
-                        self.get_django_field_name() + "_display_value": display_value,
-                    }
-                    oLookupModel = LookupModel(**args)
-                    oLookupModel.save()
-        else:
-            if not self.unique_name in entry:
-                # print('field missing from data: {}'.format(self.unique_name))
-                # there are fields that don't return a value because they are just a label or something
-                return
-            if entry[self.unique_name] == "":
-                return
-            if self.django_data_type == "FloatField":
-                try:
-                    value = float(entry[self.unique_name])
-                except ValueError:
-                    print(
-                        "unable to convert string to float for {}: {}".format(
-                            self.get_django_field_name(), entry[self.unique_name]
-                        )
-                    )
-                    return
-            elif self.django_data_type == "IntegerField":
-                try:
-                    value = int(entry[self.unique_name])
-                except ValueError:
-                    print(
-                        "unable to convert string to integer for {}: {}".format(
-                            self.get_django_field_name(), entry[self.unique_name]
-                        )
-                    )
-                    return
-            elif self.django_data_type == "DateField":
-                date_str = entry[self.unique_name]
-                if date_str:
-                    try:
-                        value = parse(date_str)
-                    except ValueError:
-                        print(
-                            "unable to convert string to date for {}: {}".format(
-                                self.get_django_field_name(), date_str
-                            )
-                        )
-                        return
-            elif self.django_data_type == "BooleanField":
-                x = entry[self.unique_name]
-                if x is True or x == 1 or x == "1":
-                    value = True
-                elif x is False or x == 0 or x == "0":
-                    value = False
-                elif x is None:
-                    value = None
-                else:
-                    print(
-                        "Unrecognized value for boolean field for {}, setting to None: {}".format(
-                            self.get_django_field_name(), entry[self.unique_name]
-                        )
-                    )
-                    value = None
-            else:
-                value = entry[self.unique_name]
-            setattr(oInstrument, self.get_django_field_name(), value)
-            lookup = self.get_display_lookup()
-            if lookup:
-                #                 print('lookup')
-                #                 print(lookup)
-                #                 print(self)
-                #                 print(oInstrument)
-                #                 print(entry)
-                #                 print('---')
-                try:
-                    setattr(
-                        oInstrument,
-                        self.get_django_field_name() + "_display_value",
-                        lookup[value.lower()],
-                    )
-                except KeyError:
-                    print("key error for {}: {} not in {}".format(self, value.lower(), lookup))
-                    return
+        return columns_have_data(entry, self.get_load_plan().get_data_columns())
+
+    def add_value_to_instrument(self, oInstrument, entry, writer=None):
+        # loads use InstrumentLoadPlan.create_records, this converts a single row the same way
+        plan = self.get_load_plan()
+        if plan.is_many_to_many:
+            plan.add_lookups(entry, oInstrument, writer=writer)
+            return
+        if entry.get(self.unique_name, "") == "":
+            return
+        errors = []
+        for name, values in plan.build_columns([entry], errors):
+            if values[0] is not None:
+                setattr(oInstrument, name, values[0])
+        for message, name, value in errors:
+            print(message.format(name, value))
 
 
 class EtlLog(models.Model):
@@ -520,12 +580,14 @@ class EtlLog(models.Model):
 
     STATUS_ETL_STARTED = "ETL started"
     STATUS_ETL_COMPLETE = "ETL completed"
+    STATUS_ETL_FAILED = "ETL failed"
     STATUS_UPLOAD_STARTED = "upload started"
     STATUS_UPLOAD_FAILED = "upload failed"
     STATUS_UPLOAD_COMPLETE = "upload complete"
     STATUS_CHOICES = (
         (STATUS_ETL_STARTED, STATUS_ETL_STARTED),
         (STATUS_ETL_COMPLETE, STATUS_ETL_COMPLETE),
+        (STATUS_ETL_FAILED, STATUS_ETL_FAILED),
         (STATUS_UPLOAD_STARTED, STATUS_UPLOAD_STARTED),
         (STATUS_UPLOAD_FAILED, STATUS_UPLOAD_FAILED),
         (STATUS_UPLOAD_COMPLETE, STATUS_UPLOAD_COMPLETE),
@@ -545,6 +607,11 @@ class EtlLog(models.Model):
     query_count = models.IntegerField(blank=True, null=True)
     last_successful_record_number = models.IntegerField(blank=True, null=True, default=0)
     last_successful_record = models.TextField(blank=True, null=True)
+    atomic = models.BooleanField(
+        default=False,
+        help_text="loaded in a single transaction with --atomic, a failed load kept nothing to "
+        "resume",
+    )
     user = models.CharField(max_length=255, blank=True, null=True)
     file_name = models.TextField(
         blank=True, null=True, help_text="the file name if uploading a file"
@@ -553,6 +620,12 @@ class EtlLog(models.Model):
     #     blank=True, null=True, help_text="identifier for thread if using Python threading"
     # )
     comment = models.TextField(blank=True, null=True)
+    metrics = models.TextField(
+        blank=True,
+        null=True,
+        help_text="JSON with the time spent in each phase, rows written per model, SQL "
+        "statements and HTTP bytes",
+    )
 
     @classmethod
     def get_latest_record(cls):
@@ -572,6 +645,32 @@ class EtlLog(models.Model):
         instruments = self.instruments_loaded.split("\n")
         return len(instruments)
 
+    def get_metrics(self):
+        if not self.metrics:
+            return {}
+        return json.loads(self.metrics)
+
+    def get_rows_written(self):
+        rows = self.get_metrics().get("rows")
+        if rows is None:
+            return None
+        return sum(rows.values())
+
+    def get_metrics_display(self):
+        metrics = self.get_metrics()
+        if not metrics:
+            return ""
+        lines = ["wall time: {}s".format(metrics["wall_seconds"])]
+        for name, seconds in sorted(metrics["phases"].items(), key=lambda item: -item[1]):
+            lines.append("    {}: {}s".format(name, seconds))
+        lines.append("SQL statements: {}".format(metrics["sql_queries"]))
+        lines.append("HTTP bytes sent: {}".format(metrics["http_bytes_sent"]))
+        lines.append("HTTP bytes received: {}".format(metrics["http_bytes_received"]))
+        lines.append("rows written:")
+        for name, count in sorted(metrics["rows"].items()):
+            lines.append("    {}: {}".format(name, count))
+        return "\n".join(lines)
+
     class Meta:
         ordering = ["-start_date"]
         verbose_name = "ETL log"
@@ -0,0 +1,103 @@
+import csv
+import json
+import itertools
+
+
+def iter_json_array(chunks):
+    """
+    Yields each element of a JSON array as soon as it has been received, given the document as
+    an iterable of text chunks (ex. response.iter_content(decode_unicode=True)). Only one
+    element is held in memory at a time, no matter how long the array is.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    finished = False
+    chunks = iter(chunks)
+    while not finished:
+        chunk = next(chunks, None)
+        at_end = chunk is None
+        if not at_end:
+            buffer = buffer[pos:] + chunk
+            pos = 0
+        while True:
+            # skip whitespace and separators between elements
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    # REDCap reports errors as a JSON object instead of the expected list
+                    rest = buffer[pos:] + "".join(chunks)
+                    raise ValueError("Expected a JSON list from the REDCap API: {}".format(rest))
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                finished = True
+                break
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if at_end:
+                    raise
+                break  # element is incomplete, wait for the next chunk
+            if end == len(buffer) and not at_end:
+                break  # a number at the end of the buffer may still have digits to come
+            pos = end
+            yield element
+        if at_end and not finished:
+            raise ValueError("Incomplete JSON list from the REDCap API")
+
+
+def iter_lines(chunks):
+    """Splits an iterable of text chunks into lines, keeping the line endings"""
+    buffer = ""
+    for chunk in chunks:
+        lines = (buffer + chunk).split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if buffer:
+        yield buffer
+
+
+def iter_csv_records(chunks):
+    """
+    Yields each row of a CSV record export as a dict keyed by the header row, the same as the
+    entries of a JSON export, given the document as an iterable of text chunks. Only one row is
+    held in memory at a time.
+    """
+    lines = iter_lines(chunks)
+    header_line = next(lines, None)
+    if header_line is None:
+        return
+    header_line = header_line.lstrip("\ufeff")  # in case a byte order mark was sent
+    if header_line.lstrip().startswith("{"):
+        # REDCap reports errors as a JSON object, as long as returnFormat is json
+        rest = header_line + "".join(lines)
+        raise ValueError("Expected CSV records from the REDCap API: {}".format(rest))
+    reader = csv.reader(itertools.chain([header_line], lines))
+    header = next(reader)
+    for row in reader:
+        if row:
+            yield dict(zip(header, row))
+
+
+def iter_csv_file(path, encoding="utf-8-sig"):
+    """
+    Yields each row of a CSV file with a header row as a dict, reading one line at a time. The
+    default encoding also skips the byte order mark Excel puts at the start of CSV files.
+    """
+    with open(path, newline="", encoding=encoding) as f:
+        yield from csv.DictReader(f)
+
+
+def iter_jsonl_file(path, encoding="utf-8"):
+    """Yields the object on each line of a JSON Lines file, skipping blank lines"""
+    with open(path, encoding=encoding) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
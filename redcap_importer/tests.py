@@ -1,3 +1,663 @@
-from django.test import TestCase
+import io
+import os
+import csv
+import json
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+import importlib
+import threading
+import contextlib
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from redcap_importer import models
+from redcap_importer.fake_redcap import CHOICES, FakeRedcapProject, FakeRedcapServer
+from redcap_importer.load_plan import get_date_parser, parse_date, parse_iso_date
+from redcap_importer.mirror_diff import MirrorDiff
+from redcap_importer.streaming import iter_json_array, iter_csv_records
+from redcap_importer.upload_to_redcap import BatchTooLarge, UploadToRedcap
+
+# app the models generated for the fake project are written to while the tests run
+TEST_APP_NAME = "redcap_importer_test_project"
+
+# small longitudinal project with checkboxes and a repeating instrument
+PROJECT_SHAPE = dict(
+    record_count=12,
+    instrument_count=3,
+    fields_per_instrument=6,
+    event_count=2,
+    repeating_instrument_count=1,
+    checkbox_rate=0.34,
+)
+
+
+class StreamingTests(SimpleTestCase):
+    def test_json_array_split_across_chunks(self):
+        document = '[{"a": "1", "b": [1, 2]}, 12345, {"c": "x, ]"}]\n'
+        for size in (1, 3, 7, len(document)):
+            chunks = [document[i : i + size] for i in range(0, len(document), size)]
+            self.assertEqual(
+                list(iter_json_array(chunks)), [{"a": "1", "b": [1, 2]}, 12345, {"c": "x, ]"}]
+            )
+
+    def test_json_array_error_object(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['{"error": "Invalid token"}']))
+
+    def test_json_array_incomplete(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['[{"a": 1}, ']))
+
+    def test_csv_records(self):
+        document = '﻿record_id,notes\r\n1,"two\nlines"\r\n2,"has ""quotes"", commas"\r\n'
+        for size in (1, 5, len(document)):
+            chunks = [document[i : i + size] for i in range(0, len(document), size)]
+            self.assertEqual(
+                list(iter_csv_records(chunks)),
+                [
+                    {"record_id": "1", "notes": "two\nlines"},
+                    {"record_id": "2", "notes": 'has "quotes", commas'},
+                ],
+            )
+
+    def test_csv_records_error_object(self):
+        with self.assertRaises(ValueError):
+            list(iter_csv_records(['{"error": "Invalid token"}']))
+
+
+class DateParsingTests(SimpleTestCase):
+    def test_parse_iso_date(self):
+        self.assertEqual(parse_iso_date("2024-02-29"), datetime.date(2024, 2, 29))
+        # anything that isn't YYYY-MM-DD goes to dateutil
+        self.assertEqual(parse_iso_date("02/29/2024"), datetime.date(2024, 2, 29))
+        self.assertEqual(parse_iso_date("2024-02-29 13:45"), datetime.date(2024, 2, 29))
+        for value in ("2023-02-29", "not a date"):
+            with self.assertRaises(ValueError):
+                parse_iso_date(value)
+
+    def test_parse_iso_date_is_cached(self):
+        parse_iso_date("1999-12-31")
+        hits = parse_iso_date.cache_info().hits
+        self.assertEqual(parse_iso_date("1999-12-31"), datetime.date(1999, 12, 31))
+        self.assertEqual(parse_iso_date.cache_info().hits, hits + 1)
+
+    def test_get_date_parser(self):
+        for validation_type in (None, "", "date_mdy", "date_dmy", "date_ymd"):
+            self.assertIs(get_date_parser(validation_type), parse_iso_date)
+        self.assertIs(get_date_parser("datetime_mdy"), parse_date)
+
+
+class FakeRedcapTestCase(TransactionTestCase):
+    """
+    Runs against a FakeRedcapServer with the models written by redcap_write_models installed as
+    an app, so the management commands and UploadToRedcap can be tested end to end.
+
+    Every test gets a new server and data dictionary, subclasses call load() for the data.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.work_dir = tempfile.mkdtemp()
+        app_dir = os.path.join(cls.work_dir, TEST_APP_NAME)
+        os.makedirs(app_dir)
+        for file_name in ("__init__.py", "models.py"):
+            open(os.path.join(app_dir, file_name), "w").close()
+        sys.path.insert(0, cls.work_dir)
+        cls.settings_override = override_settings(
+            INSTALLED_APPS=settings.INSTALLED_APPS + [TEST_APP_NAME],
+            REDCAP_API_TOKENS={TEST_APP_NAME: "test"},
+        )
+        cls.settings_override.enable()
+
+        # write the models for the project and create their tables
+        with FakeRedcapServer(FakeRedcapProject(**PROJECT_SHAPE)) as server:
+            cls.create_connection(server)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                call_command("redcap_get_dd", TEST_APP_NAME)
+                call_command("redcap_write_models", TEST_APP_NAME)
+        with open(os.path.join(app_dir, "models.py"), "w") as f:
+            f.write(cls.get_models_code(output.getvalue()))
+        apps.clear_cache()
+        importlib.reload(importlib.import_module(TEST_APP_NAME + ".models"))
+        cls.generated_models = list(apps.get_app_config(TEST_APP_NAME).get_models())
+        with connection.schema_editor() as schema_editor:
+            for Model in cls.generated_models:
+                schema_editor.create_model(Model)
+        call_command("flush", interactive=False, verbosity=0)
+
+    @classmethod
+    def get_models_code(cls, output):
+        # redcap_get_dd prints progress before the models code
+        start = output.index("from django.db import models")
+        return output[start:]
+
+    @classmethod
+    def tearDownClass(cls):
+        with connection.schema_editor() as schema_editor:
+            for Model in cls.generated_models:
+                schema_editor.delete_model(Model)
+        cls.settings_override.disable()
+        sys.modules.pop(TEST_APP_NAME + ".models", None)
+        sys.modules.pop(TEST_APP_NAME, None)
+        sys.path.remove(cls.work_dir)
+        shutil.rmtree(cls.work_dir)
+        super().tearDownClass()
+
+    @classmethod
+    def create_connection(cls, server):
+        oApiUrl = models.RedcapApiUrl.objects.create(name="fake", url=server.url)
+        return models.RedcapConnection.objects.create(unique_name=TEST_APP_NAME, api_url=oApiUrl)
+
+    def setUp(self):
+        self.project = FakeRedcapProject(**PROJECT_SHAPE)
+        self.server = FakeRedcapServer(self.project).start()
+        self.addCleanup(self.server.stop)
+        self.oConnection = self.create_connection(self.server)
+        self.call_quietly("redcap_get_dd", TEST_APP_NAME)
+
+    def call_quietly(self, *args, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command(*args, stdout=io.StringIO(), **options)
+
+    def load(self, **options):
+        self.call_quietly("redcap_load_data", TEST_APP_NAME, **options)
+
+    def get_model(self, model_name):
+        return apps.get_model(app_label=TEST_APP_NAME, model_name=model_name)
+
+    def count_rows(self):
+        return {Model._meta.model_name: Model.objects.count() for Model in self.generated_models}
+
+    def get_latest_log(self):
+        return models.EtlLog.objects.latest("id")
+
+    def capture_requests(self):
+        """Returns a list that the parameters of every request to the server are added to"""
+        requests = []
+        handle_request = self.server.handle_request
+
+        def capturing_handle_request(params):
+            requests.append(params)
+            return handle_request(params)
+
+        self.server.handle_request = capturing_handle_request
+        return requests
+
+
+class LoadDataTests(FakeRedcapTestCase):
+    def test_load(self):
+        self.load(chunk_size=5)
+        self.assertEqual(self.get_model("ProjectRoot").objects.count(), 12)
+        self.assertEqual(self.get_latest_log().status, models.EtlLog.STATUS_ETL_COMPLETE)
+        # CSV downloads load the same rows as JSON
+        rows = self.count_rows()
+        self.oConnection.export_format = models.RedcapConnection.ExportFormat.CSV
+        self.oConnection.save()
+        self.load(chunk_size=5)
+        self.assertEqual(self.count_rows(), rows)
+
+    def test_workers(self):
+        Instrument = self.get_model("instrument_1")
+        names = ("redcap_event__project_root_id", "redcap_event__event_unique_name", "i1_f1")
+        self.load(chunk_size=2)
+        rows = self.count_rows()
+        values = list(Instrument.objects.values_list(*names).order_by(*names))
+
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+        handle_request = self.server.handle_request
+
+        def slow_handle_request(params):
+            if "records[0]" not in params:
+                return handle_request(params)
+            with lock:
+                in_flight.append(params)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(params)
+            return handle_request(params)
+
+        self.server.handle_request = slow_handle_request
+        self.load(chunk_size=2, workers=3)
+        self.assertEqual(self.get_latest_log().status, models.EtlLog.STATUS_ETL_COMPLETE)
+        self.assertEqual(self.count_rows(), rows)
+        self.assertEqual(list(Instrument.objects.values_list(*names).order_by(*names)), values)
+        # the six chunks were fetched up to three at a time
+        self.assertEqual(len(max_in_flight), 6)
+        self.assertEqual(max(max_in_flight), 3)
+
+    def test_connections_are_reused(self):
+        for export_format in models.RedcapConnection.ExportFormat.values:
+            self.oConnection.export_format = export_format
+            self.oConnection.save()
+            connections_before = self.server.connection_count
+            self.load(chunk_size=1)
+            self.assertEqual(self.server.connection_count - connections_before, 1, export_format)
+
+    def test_incremental(self):
+        self.load()
+        rows = self.count_rows()
+        record = next(self.project.export_records(records=["3"]))
+        self.project.import_records(
+            [
+                {
+                    "record_id": "3",
+                    "redcap_event_name": record["redcap_event_name"],
+                    "i1_f1": "changed",
+                }
+            ]
+        )
+        self.load(incremental=True)
+        self.assertIn("1 changed records", self.get_latest_log().comment)
+        self.assertEqual(self.count_rows(), rows)
+        Instrument = self.get_model("instrument_1")
+        self.assertTrue(
+            Instrument.objects.filter(redcap_event__project_root_id="3", i1_f1="changed").exists()
+        )
+
+    def test_resume(self):
+        self.load(chunk_size=3)
+        rows = self.count_rows()
+
+        # fail the third chunk of records
+        handle_request = self.server.handle_request
+        record_requests = []
+
+        def failing_handle_request(params):
+            if params.get("content") == "record" and "records[0]" in params:
+                record_requests.append(params)
+                if len(record_requests) == 3:
+                    return 500, {"error": "injected error"}
+            return handle_request(params)
+
+        self.server.handle_request = failing_handle_request
+        with self.assertRaises(ValueError):
+            self.load(chunk_size=3)
+        oEtlLog = self.get_latest_log()
+        self.assertEqual(oEtlLog.status, models.EtlLog.STATUS_ETL_FAILED)
+        self.assertEqual(oEtlLog.last_successful_record_number, 6)
+
+        self.load(chunk_size=3, resume=True)
+        oEtlLog.refresh_from_db()
+        self.assertEqual(oEtlLog.status, models.EtlLog.STATUS_ETL_COMPLETE)
+        self.assertEqual(self.count_rows(), rows)
+
+    def test_atomic_load(self):
+        self.load()
+        rows = self.count_rows()
+        record = next(self.project.export_records(records=["3"]))
+        self.project.import_records(
+            [
+                {
+                    "record_id": "3",
+                    "redcap_event_name": record["redcap_event_name"],
+                    "i1_f1": "changed",
+                }
+            ]
+        )
+        self.load(atomic=True, chunk_size=5)
+        oEtlLog = self.get_latest_log()
+        self.assertEqual(oEtlLog.status, models.EtlLog.STATUS_ETL_COMPLETE)
+        self.assertTrue(oEtlLog.atomic)
+        self.assertEqual(self.count_rows(), rows)
+        Instrument = self.get_model("instrument_1")
+        self.assertTrue(
+            Instrument.objects.filter(redcap_event__project_root_id="3", i1_f1="changed").exists()
+        )
+
+    def test_atomic_load_failure(self):
+        self.load()
+        rows = self.count_rows()
+        requests = []
+        handle_request = self.server.handle_request
+
+        def failing_handle_request(params):
+            if "records[0]" in params:
+                requests.append(params)
+                if len(requests) == 8:
+                    return 500, {"error": "injected error"}
+            return handle_request(params)
+
+        self.server.handle_request = failing_handle_request
+        with self.assertRaises(ValueError):
+            self.load(atomic=True)
+        # the previous data is still there and the failed load has nothing to resume from
+        self.assertEqual(self.count_rows(), rows)
+        oEtlLog = self.get_latest_log()
+        self.assertEqual(oEtlLog.status, models.EtlLog.STATUS_ETL_FAILED)
+        self.assertTrue(oEtlLog.atomic)
+        self.assertFalse(oEtlLog.last_successful_record_number)
+        with self.assertRaises(CommandError):
+            self.load(resume=True, incremental=True)
+        self.assertEqual(self.count_rows(), rows)
+
+    def test_unchecked_checkboxes_are_not_data(self):
+        # REDCap exports "0" for every checkbox column of a form that wasn't filled in. Not the
+        # first instrument, which has the record id
+        event_name = next(self.project.export_records(records=["3"]))["redcap_event_name"]
+        row = {"record_id": "13", "redcap_event_name": event_name}
+        for field_name in ("i2_f3", "i2_f6"):
+            for code, label in CHOICES:
+                row["{}___{}".format(field_name, code)] = "0"
+        self.project.import_records([row])
+        self.load()
+        Instrument = self.get_model("instrument_2")
+        self.assertTrue(self.get_model("ProjectRoot").objects.filter(record_id="13").exists())
+        self.assertFalse(Instrument.objects.filter(redcap_event__project_root_id="13").exists())
+
+        self.project.import_records([dict(row, i2_f3___2="1")])
+        self.load()
+        (oRecord,) = Instrument.objects.filter(redcap_event__project_root_id="13")
+        self.assertEqual(
+            list(oRecord.instrument_2_i2_f3_lookup_set.values_list("i2_f3", flat=True)), ["2"]
+        )
+
+    def test_delete_loaded_data(self):
+        self.load()
+        oProject = self.oConnection.projectmetadata
+        Models = oProject.get_generated_models()
+        self.assertEqual(set(Models), set(self.generated_models))
+        # each model comes before the models it points to
+        for idx, Model in enumerate(Models):
+            for field in Model._meta.concrete_fields:
+                if field.is_relation:
+                    self.assertIn(field.related_model, Models[idx + 1 :])
+
+        rows = self.count_rows()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                oProject.delete_loaded_data()
+                self.assertFalse(any(self.count_rows().values()))
+                raise ValueError("roll back")
+        self.assertEqual(self.count_rows(), rows)
+
+        for truncate in (True, False):
+            self.load()
+            oProject.delete_loaded_data(truncate=truncate)
+            self.assertFalse(any(self.count_rows().values()), truncate)
+
+    def test_resume_refuses_running_load(self):
+        models.EtlLog.objects.create(
+            redcap_project=TEST_APP_NAME,
+            start_date=datetime.datetime.now(),
+            status=models.EtlLog.STATUS_ETL_STARTED,
+            direction=models.EtlLog.Direction.DOWNLOAD,
+        )
+        with self.assertRaises(CommandError):
+            self.load(resume=True)
+
+    def test_include_fields(self):
+        self.oConnection.partial_load = True
+        self.oConnection.save()
+        for instrument_name in ("instrument_1", "instrument_2"):
+            models.IncludeInstrument.objects.create(
+                connection=self.oConnection, instrument_name=instrument_name
+            )
+        models.IncludeField.objects.create(connection=self.oConnection, field_name="i1_f1")
+        requests = self.capture_requests()
+        self.load()
+
+        record_requests = [params for params in requests if "records[0]" in params]
+        self.assertEqual(len(record_requests), 12)
+        record_request = record_requests[0]
+        self.assertEqual(
+            (record_request["fields[0]"], record_request["fields[1]"]), ("record_id", "i1_f1")
+        )
+        self.assertNotIn("fields[2]", record_request)
+        self.assertEqual(record_request["forms[0]"], "instrument_2")
+        self.assertNotIn("forms[1]", record_request)
+        Instrument = self.get_model("instrument_1")
+        self.assertTrue(Instrument.objects.exclude(i1_f1=None).exists())
+        self.assertFalse(Instrument.objects.exclude(i1_f2=None).exists())
+        self.assertTrue(self.get_model("instrument_2").objects.exists())
+        self.assertFalse(self.get_model("instrument_3").objects.exists())
+
+        oInstrument = models.InstrumentMetadata.objects.get(unique_name="instrument_1")
+        self.assertEqual(
+            [oField.unique_name for oField in oInstrument.get_fields_to_load()], ["i1_f1"]
+        )
+        # fields left out of the generated models have no stats instead of raising errors
+        for oField in oInstrument.fieldmetadata_set.all():
+            oField.django_field_name = "left_out"
+            self.assertEqual(oField.get_stats()[0]["count"], 0, oField.unique_name)
+
+
+class LoadAllTests(TransactionTestCase):
+    """
+    redcap_load_all with the loads run on threads instead of worker processes, and
+    load_connection replaced so no project has to be set up
+    """
+
+    def setUp(self):
+        self.servers = {}  # connection name: api url name
+        for api_url_name, connection_names in (("a", ["a1", "a2", "a3", "a4"]), ("b", ["b1"])):
+            oApiUrl = models.RedcapApiUrl.objects.create(
+                name=api_url_name, url="http://{}.invalid/api/".format(api_url_name)
+            )
+            for connection_name in connection_names:
+                oConnection = models.RedcapConnection.objects.create(
+                    unique_name=connection_name, api_url=oApiUrl
+                )
+                models.ProjectMetadata.objects.create(
+                    connection=oConnection,
+                    project_title=connection_name,
+                    is_longitudinal=False,
+                    primary_key_field="record_id",
+                )
+                self.servers[connection_name] = api_url_name
+        # no data dictionary, so not loaded by default
+        models.RedcapConnection.objects.create(unique_name="no_dd", api_url=oApiUrl)
+
+    def load_all(self, *connection_names, failing=(), **options):
+        lock = threading.Lock()
+        running = []
+        self.loaded = {}  # connection name: load options
+        self.max_running = 0
+        self.max_running_per_server = {}
+
+        def load_connection(connection_name, load_options):
+            with lock:
+                running.append(connection_name)
+                self.loaded[connection_name] = load_options
+                self.max_running = max(self.max_running, len(running))
+                server = self.servers[connection_name]
+                count = len([name for name in running if self.servers[name] == server])
+                self.max_running_per_server[server] = max(
+                    self.max_running_per_server.get(server, 0), count
+                )
+            time.sleep(0.1)
+            with lock:
+                running.remove(connection_name)
+            return connection_name not in failing, "loaded {}\n".format(connection_name)
+
+        command_module = "redcap_importer.management.commands.redcap_load_all"
+        with mock.patch(command_module + ".ProcessPoolExecutor", ThreadPoolExecutor):
+            with mock.patch(command_module + ".load_connection", load_connection):
+                call_command(
+                    "redcap_load_all",
+                    *connection_names,
+                    stdout=io.StringIO(),
+                    stderr=io.StringIO(),
+                    **options
+                )
+
+    def test_limits(self):
+        self.load_all(processes=3, max_per_server=2, chunk_size=5)
+        self.assertEqual(set(self.loaded), {"a1", "a2", "a3", "a4", "b1"})
+        self.assertEqual(self.loaded["a1"]["chunk_size"], 5)
+        self.assertEqual(self.max_running, 3)
+        self.assertEqual(self.max_running_per_server, {"a": 2, "b": 1})
+
+    def test_failed_load(self):
+        # the command fails, so manage.py exits with an error, once every load has run
+        with self.assertRaisesMessage(CommandError, "1 failed to load: a2"):
+            self.load_all(failing=["a2"], processes=2)
+        self.assertEqual(set(self.loaded), {"a1", "a2", "a3", "a4", "b1"})
+
+    def test_connection_names(self):
+        self.load_all("b1", "a3")
+        self.assertEqual(set(self.loaded), {"a3", "b1"})
+        with self.assertRaises(CommandError):
+            self.load_all("no_dd")
+
+
+class UploadTests(FakeRedcapTestCase):
+    def get_upload_rows(self, record_count):
+        return [
+            {"record_id": str(i), "i1_f1": "value {}".format(i)} for i in range(1, record_count)
+        ]
+
+    def test_concurrent_upload(self):
+        rows = self.get_upload_rows(41)
+        threads = set()
+        ensure_connection = BaseDatabaseWrapper.ensure_connection
+
+        def record_thread(self):
+            threads.add(threading.current_thread().name)
+            return ensure_connection(self)
+
+        with mock.patch.object(BaseDatabaseWrapper, "ensure_connection", record_thread):
+            with contextlib.redirect_stdout(io.StringIO()):
+                UploadToRedcap(TEST_APP_NAME, batch_size=5, workers=3).upload(rows)
+        oEtlLog = self.get_latest_log()
+        self.assertEqual(oEtlLog.status, models.EtlLog.STATUS_UPLOAD_COMPLETE)
+        self.assertEqual(oEtlLog.last_successful_record_number, 40)
+        self.assertEqual(self.project.imported[("40", "", "", "")]["i1_f1"], "value 40")
+        # batches are sent from worker threads, which don't use the database
+        self.assertEqual(threads, {threading.current_thread().name})
+
+    def test_concurrent_upload_failure(self):
+        import_records = self.project.import_records
+
+        def failing_import_records(data):
+            if data[0]["record_id"] == "1":
+                time.sleep(0.5)  # still in flight when the third batch fails
+            if data[0]["record_id"] == "11":
+                return 0
+            return import_records(data)
+
+        def slow_rows():
+            for row in self.get_upload_rows(41):
+                time.sleep(0.01)
+                yield row
+
+        self.project.import_records = failing_import_records
+        with self.assertRaises(Exception):
+            with contextlib.redirect_stdout(io.StringIO()):
+                UploadToRedcap(TEST_APP_NAME, batch_size=5, workers=4).upload(slow_rows())
+        oEtlLog = self.get_latest_log()
+        self.assertEqual(oEtlLog.status, models.EtlLog.STATUS_UPLOAD_FAILED)
+        # the two batches sent before the one that failed
+        self.assertEqual(oEtlLog.last_successful_record_number, 10)
+
+    def test_adaptive_batch_size(self):
+        # the server only takes requests with about a dozen records
+        rows = self.get_upload_rows(41)
+        self.server.max_request_bytes = 1000
+        with self.assertRaises(BatchTooLarge):
+            with contextlib.redirect_stdout(io.StringIO()):
+                UploadToRedcap(TEST_APP_NAME, batch_size=20).upload(rows)
+        self.assertEqual(self.get_latest_log().last_successful_record_number, 0)
+
+        oUploader = UploadToRedcap(TEST_APP_NAME, batch_size=20, adaptive_batch_size=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            oUploader.upload(rows)
+        oEtlLog = self.get_latest_log()
+        self.assertEqual(oEtlLog.status, models.EtlLog.STATUS_UPLOAD_COMPLETE)
+        self.assertEqual(oEtlLog.last_successful_record_number, 40)
+        self.assertIn("batch sizes: ", oEtlLog.comment)
+        self.assertEqual(self.project.imported[("40", "", "", "")]["i1_f1"], "value 40")
+        # batches that were too large were split, and later ones were kept smaller
+        self.assertLess(oUploader.max_batch_bytes, 1000)
+        self.assertLess(max(oUploader.batch_size_counts), 20)
+        self.assertEqual(
+            sum(size * count for size, count in oUploader.batch_size_counts.items()), 40
+        )
+
+    def test_upload_files(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        csv_path = os.path.join(work_dir, "first.csv")
+        with open(csv_path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.DictWriter(f, ["record_id", "i1_f1"])
+            writer.writeheader()
+            writer.writerows(self.get_upload_rows(8))
+        jsonl_path = os.path.join(work_dir, "second.jsonl")
+        with open(jsonl_path, "w") as f:
+            for row in self.get_upload_rows(4):
+                f.write(json.dumps(dict(row, i1_f1="second")) + "\n\n")
+
+        oUpload = UploadToRedcap(TEST_APP_NAME, batch_size=3)
+        with contextlib.redirect_stdout(io.StringIO()):
+            oUpload.upload_csv(csv_path)
+            oUpload.upload_jsonl(jsonl_path)
+        first_log, second_log = models.EtlLog.objects.order_by("id")
+        self.assertEqual(
+            (first_log.file_name, first_log.last_successful_record_number), ("first.csv", 7)
+        )
+        self.assertEqual(
+            (second_log.file_name, second_log.last_successful_record_number), ("second.jsonl", 3)
+        )
+        self.assertEqual(self.project.imported[("3", "", "", "")]["i1_f1"], "second")
+        self.assertEqual(self.project.imported[("7", "", "", "")]["i1_f1"], "value 7")
+
+
+class SkipUnchangedTests(FakeRedcapTestCase):
+    def setUp(self):
+        super().setUp()
+        self.load()
+        self.rows = list(self.project.export_records())
+
+    def upload(self, rows):
+        requests_before = self.server.request_count
+        with contextlib.redirect_stdout(io.StringIO()):
+            UploadToRedcap(TEST_APP_NAME, skip_unchanged=True).upload(rows)
+        return self.server.request_count - requests_before
+
+    def test_unchanged_records_are_not_sent(self):
+        self.assertEqual(self.upload(self.rows), 0)
+        oEtlLog = self.get_latest_log()
+        self.assertEqual(oEtlLog.last_successful_record_number, len(self.rows))
+        self.assertIn("{} unchanged records not sent".format(len(self.rows)), oEtlLog.comment)
+
+    def test_changed_instrument_is_sent(self):
+        row = dict(self.rows[0], i1_f1="changed")
+        oMirrorDiff = MirrorDiff(self.oConnection)
+        (sent,) = oMirrorDiff.filter_batch([UploadToRedcap(TEST_APP_NAME).process_record(row)])
+        self.assertEqual(sent["i1_f1"], "changed")
+        self.assertEqual(sent["record_id"], row["record_id"])
+        self.assertNotIn("i2_f1", sent)
+
+    def test_form_status_is_sent(self):
+        row = next(row for row in self.rows if row["instrument_1_complete"] == "2")
+        self.assertEqual(self.upload([dict(row, instrument_1_complete="1")]), 1)
+        key = (row["record_id"], row["redcap_event_name"], "", "")
+        sent = self.project.imported[key]
+        self.assertEqual(sent["instrument_1_complete"], "1")
+        self.assertEqual(sent["i1_f1"], row["i1_f1"])
+        self.assertNotIn("instrument_2_complete", sent)
+
+    def test_form_status_without_status_column(self):
+        # models generated before redcap_form_status was added can't compare statuses
+        oMirrorDiff = MirrorDiff(self.oConnection)
+        for plan in oMirrorDiff.plans.values():
+            plan.has_form_status = False
+        row = next(row for row in self.rows if row["instrument_1_complete"] == "2")
+        (sent,) = oMirrorDiff.filter_batch([UploadToRedcap(TEST_APP_NAME).process_record(row)])
+        self.assertEqual(sent["instrument_1_complete"], "2")
+        self.assertNotIn("i1_f1", sent)
@@ -1,9 +1,55 @@
+import os
 import json
+import time
 import datetime
+import threading
+import collections
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import dateparser
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from urllib3.util.retry import Retry
+from django.db.models import QuerySet
 
 from redcap_importer.models import RedcapConnection, FieldMetadata, EtlLog
+from redcap_importer.etl_metrics import EtlMetrics
+from redcap_importer.mirror_diff import MirrorDiff
+from redcap_importer.streaming import iter_csv_file, iter_jsonl_file
+
+# HTTP statuses REDCap or the server in front of it send for a request that is too big or slow
+BATCH_TOO_LARGE_STATUSES = (413, 502, 504)
+
+
+class BatchTooLarge(Exception):
+    """A batch was rejected for its size, or timed out"""
+
+
+@lru_cache(maxsize=8192)
+def parse_upload_date(value):
+    """Returns a date string as YYYY-MM-DD, most uploads repeat the same dates many times"""
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        return dateparser.parse(value).strftime("%Y-%m-%d")
+
+
+def convert_upload_value(key, val):
+    if val is None or val == "":
+        return ""
+    if isinstance(val, datetime.date):
+        return val.strftime("%Y-%m-%d")
+    return val
+
+
+def convert_upload_date(key, val):
+    if val is None or val == "" or isinstance(val, datetime.date):
+        return convert_upload_value(key, val)
+    try:
+        return parse_upload_date(val)
+    except Exception:
+        raise Exception("Unable to parser value {} for date field {}".format(val, key))
 
 
 class UploadToRedcap:
@@ -13,8 +59,21 @@ class UploadToRedcap:
     How to use:
     - use init to set redcap project, batch size, etc.
     - use upload() method to upload your data
-        - data must be a list of dicts with field:value pairs
+        - data must be an iterable of dicts with field:value pairs, ex. a list, a generator or a
+          values() queryset
         - data must be set up in the structure that the REDCap API expects
+        - records are read as they are needed, so only a few batches are held in memory
+    - use upload_csv() or upload_jsonl() to upload straight from a file
+    - set workers to send more than one batch at a time
+        - batches are still prepared in order, and last_successful_record_number only counts
+          batches up to the first one that hasn't succeeded
+    - set adaptive_batch_size to tune the batch size while uploading, starting at batch_size
+        - it doubles while requests take less than half of target_seconds and shrinks when they
+          take longer
+        - a batch that is rejected as too large or times out is split in half and sent again,
+          and later batches are kept under the size in bytes that failed
+    - set skip_unchanged to leave out values that match the local copy of the project loaded by
+      redcap_load_data, see MirrorDiff
     """
 
     def __init__(
@@ -25,8 +84,17 @@ class UploadToRedcap:
         user=None,
         initial_comment="",
         file_name=None,
+        workers=1,
+        adaptive_batch_size=False,
+        target_seconds=10,
+        max_batch_size=10000,
+        timeout=None,
+        skip_unchanged=False,
     ):
-        self.connection = RedcapConnection.objects.get(unique_name=redcap_project_name)
+        # the API url is read while sending batches, which may happen on worker threads
+        self.connection = RedcapConnection.objects.select_related("api_url").get(
+            unique_name=redcap_project_name
+        )
         self.create_log_entry = create_log_entry
         self.query_count = 0
         self.last_successful_record_number = 0
@@ -35,8 +103,36 @@ class UploadToRedcap:
         self.user = user
         self.file_name = file_name
         self.initial_comment = initial_comment
+        self.metrics = EtlMetrics()
+        self.field_types = None
+        self.converters = {}
+        self.workers = max(workers, 1)
+        self.adaptive_batch_size = adaptive_batch_size
+        self.target_seconds = target_seconds
+        self.max_batch_size = max_batch_size
+        # give up on a request after this many seconds, a timed out batch is split when adaptive
+        if timeout is None and adaptive_batch_size:
+            timeout = target_seconds * 6
+        self.timeout = timeout
+        self.max_batch_bytes = None  # learned from batches that were too large
+        self.batch_size_counts = collections.Counter()  # batch size: requests that succeeded
+        self.skip_unchanged = skip_unchanged
+        self.mirror_diff = None
+        self.skipped_count = 0  # records left out because nothing in them changed
+        self.unsent_count = 0  # records of dataset not counted as done yet, as nothing was sent
+        self.batch_size_lock = threading.Lock()
+        self.query_count_lock = threading.Lock()  # requests may be sent from worker threads
+        # reuse connections between batches and make several attempts to recover from network
+        # errors, like redcap_load_data
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            max_retries=Retry(connect=3, backoff_factor=0.5),
+            pool_maxsize=max(self.workers, DEFAULT_POOLSIZE),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-    def start_log_entry(self):
+    def start_log_entry(self, file_name=None):
         self.log = EtlLog(
             redcap_project=self.connection.unique_name,
             start_date=datetime.datetime.now(),
@@ -45,8 +141,8 @@ class UploadToRedcap:
         )
         if self.user:
             self.log.user = self.user.username
-        if self.file_name:
-            self.log.file_name = self.file_name
+        if file_name or self.file_name:
+            self.log.file_name = file_name or self.file_name
         if self.initial_comment:
             self.log.comment = self.initial_comment
         self.log.save()
@@ -69,29 +165,54 @@ class UploadToRedcap:
                 self.log.comment = error_msg
         else:
             self.log.status = EtlLog.STATUS_UPLOAD_COMPLETE
+        comments = [self.log.comment]
+        if self.adaptive_batch_size and self.batch_size_counts:
+            comments.append(self.get_batch_size_summary())
+        if self.skip_unchanged:
+            comments.append("{} unchanged records not sent".format(self.skipped_count))
+        self.log.comment = "\n".join(comment for comment in comments if comment)
         self.log.query_count = self.query_count
+        self.log.metrics = json.dumps(self.metrics.as_dict())
         self.log.end_date = datetime.datetime.now()
         self.log.save()
 
-    def upload(self, dataset):
+    def upload(self, dataset, file_name=None):
         """
-        dataset should be a list of dicts with field:value pairs
+        dataset should be an iterable of dicts with field:value pairs. Querysets are read with
+        iterator(), so they are not cached in memory either. file_name is saved with the ETL log
+        of this upload instead of the one given to init.
         """
         print("uploading to {}".format(self.connection.unique_name))
+        if isinstance(dataset, QuerySet):
+            dataset = dataset.iterator(chunk_size=self.batch_size)
+        self.metrics = EtlMetrics()
         if self.create_log_entry:
-            self.start_log_entry()
+            self.start_log_entry(file_name)
+        self.last_successful_record_number = 0
+        self.last_successful_record = ""
+        # pick up data dictionary changes made since the last upload
+        self.field_types = None
+        self.converters = {}
+        self.batch_size_counts = collections.Counter()
+        self.skipped_count = 0
+        self.unsent_count = 0
 
         try:
-            upload_records = []
-            for record in dataset:
-                next_entry = self.process_record(record)
-                upload_records.append(next_entry)
-                if len(upload_records) >= self.batch_size:
-                    self.upload_batch(upload_records)
-                    upload_records = []
-            # upload the last group of records
-            if upload_records:
-                self.upload_batch(upload_records)
+            with self.metrics.count_queries():
+                if self.skip_unchanged:
+                    with self.metrics.phase("compare"):
+                        self.mirror_diff = MirrorDiff(self.connection)
+                batches = self.iter_batches(dataset)
+                if self.workers > 1:
+                    self.upload_batches_concurrently(batches)
+                else:
+                    for upload_records, record_count in batches:
+                        self.upload_batch(upload_records, record_count)
+                if self.unsent_count:
+                    # the last records were all unchanged, count them as done
+                    self.last_successful_record_number += self.unsent_count
+                    if self.create_log_entry:
+                        self.update_log_entry_finish_query()
         except Exception as e:
             # handle failed load
             print("upload failed")
@@ -104,59 +225,203 @@ class UploadToRedcap:
         if self.create_log_entry:
             self.finish_log_entry()
 
-    def upload_batch(self, upload_records):
-        upload_json = json.dumps(upload_records)
-        response = self.run_request(
-            "record",
-            {
-                "data": upload_json,
-                "overwriteBehavior": "overwrite",  # "normal" or "overwrite"
-            },
-        )
+    def upload_csv(self, path, encoding="utf-8-sig"):
+        """Uploads a CSV file with a header row of REDCap field names, one line at a time"""
+        self.upload(iter_csv_file(path, encoding=encoding), file_name=os.path.basename(path))
+
+    def upload_jsonl(self, path, encoding="utf-8"):
+        """Uploads a JSON Lines file with one record object per line, one line at a time"""
+        self.upload(iter_jsonl_file(path, encoding=encoding), file_name=os.path.basename(path))
+
+    def iter_batches(self, dataset):
+        """
+        Yields (records ready for the API, number of records of dataset they stand for),
+        batch_size records of dataset at a time. The numbers differ when unchanged records are
+        left out.
+        """
+        upload_records = []
+        for record in dataset:
+            with self.metrics.phase("convert"):
+                next_entry = self.process_record(record)
+            upload_records.append(next_entry)
+            if len(upload_records) >= self.batch_size:
+                yield from self.filter_batch(upload_records)
+                upload_records = []
+        # upload the last group of records
+        if upload_records:
+            yield from self.filter_batch(upload_records)
+
+    def filter_batch(self, upload_records):
+        """Yields the batch with unchanged records left out if skip_unchanged is set"""
+        record_count = len(upload_records)
+        if self.skip_unchanged:
+            with self.metrics.phase("compare"):
+                upload_records = self.mirror_diff.filter_batch(upload_records)
+            self.skipped_count += record_count - len(upload_records)
+        # records from batches with nothing to send are counted with the next batch sent
+        record_count += self.unsent_count
+        if not upload_records:
+            self.unsent_count = record_count
+            return
+        self.unsent_count = 0
+        yield upload_records, record_count
+
+    def upload_batch(self, upload_records, record_count):
+        self.start_request()
+        self.send_batch(upload_records)
+        self.finish_batch(upload_records, record_count)
+
+    def upload_batches_concurrently(self, batches):
+        """
+        Sends up to self.workers batches at a time on a thread pool. Batches are finished in the
+        order they were sent, so last_successful_record_number never counts past a batch that
+        hasn't succeeded. Once a batch fails no more are sent, the batches sent before it are
+        finished and the ones in flight are waited for before the error is raised.
+        """
+        in_flight = collections.deque()  # (future, batch, record count) in the order sent
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for upload_records, record_count in batches:
+                # finish what is done, and wait for the oldest batch if all workers are busy
+                while in_flight and (len(in_flight) >= self.workers or in_flight[0][0].done()):
+                    future, done_records, done_count = in_flight.popleft()
+                    future.result()
+                    self.finish_batch(done_records, done_count)
+                if any(future.done() and future.exception() for future, _, _ in in_flight):
+                    break  # stop sending, the loop below raises the error
+                self.start_request()
+                future = executor.submit(self.send_batch, upload_records)
+                in_flight.append((future, upload_records, record_count))
+            # finish in order up to the first batch that failed, which raises its error
+            while in_flight:
+                future, done_records, done_count = in_flight.popleft()
+                future.result()
+                self.finish_batch(done_records, done_count)
+        # leaving the with block after an error waits for the batches still in flight
+
+    def send_batch(self, upload_records):
+        """Sends one batch to REDCap. It doesn't use the database, so it can run on a thread."""
+        with self.metrics.phase("serialize"):
+            upload_json = json.dumps(upload_records)
+        started = time.perf_counter()
+        try:
+            response = self.post_request(
+                "record",
+                {
+                    "data": upload_json,
+                    "overwriteBehavior": "overwrite",  # "normal" or "overwrite"
+                },
+            )
+        except BatchTooLarge as e:
+            if not self.adaptive_batch_size or len(upload_records) == 1:
+                raise
+            print("{}, splitting a batch of {} records".format(e, len(upload_records)))
+            self.shrink_batch_size(upload_records, len(upload_json))
+            half = len(upload_records) // 2
+            for part in (upload_records[:half], upload_records[half:]):
+                self.count_request()
+                self.send_batch(part)
+            return
         print(str(response))
         # count will show number of subjects affected, not number of records uploaded
         # if 'count' not in response or response['count'] != len(upload_records):
         #     raise Exception(str(response))
         if "count" not in response or response["count"] == 0:
             raise Exception(str(response))
-        else:
-            # need to document the last record that uploaded successfully
-            self.last_successful_record_number += len(upload_records)
-            self.last_successful_record = upload_records[-1]
+        if self.adaptive_batch_size:
+            self.adjust_batch_size(upload_records, len(upload_json), time.perf_counter() - started)
+        return response
+
+    def adjust_batch_size(self, upload_records, payload_bytes, seconds):
+        """Picks the size of the next batch from how long this one took"""
+        with self.batch_size_lock:
+            self.batch_size_counts[len(upload_records)] += 1
+            batch_size = self.batch_size
+            if seconds > self.target_seconds:
+                batch_size = int(len(upload_records) * self.target_seconds / seconds)
+            elif seconds < self.target_seconds / 2 and len(upload_records) >= self.batch_size:
+                # only full batches say anything about a bigger size, not the last one
+                batch_size = self.batch_size * 2
+            if self.max_batch_bytes:
+                bytes_per_record = payload_bytes / len(upload_records)
+                batch_size = min(batch_size, int(self.max_batch_bytes / bytes_per_record))
+            self.batch_size = max(1, min(batch_size, self.max_batch_size))
+
+    def shrink_batch_size(self, upload_records, payload_bytes):
+        """Keeps later batches under the size of one that was too large"""
+        with self.batch_size_lock:
+            self.max_batch_bytes = min(payload_bytes // 2, self.max_batch_bytes or payload_bytes)
+            self.batch_size = max(1, min(self.batch_size, len(upload_records) // 2))
+
+    def get_batch_size_summary(self):
+        sizes = ", ".join(
+            "{} x{}".format(size, count) for size, count in sorted(self.batch_size_counts.items())
+        )
+        return "batch sizes: {}".format(sizes)
+
+    def finish_batch(self, upload_records, record_count=None):
+        # need to document the last record that uploaded successfully
+        if record_count is None:
+            record_count = len(upload_records)
+        self.last_successful_record_number += record_count
+        self.metrics.add_rows("REDCap " + self.connection.unique_name, len(upload_records))
+        self.last_successful_record = upload_records[-1]
+        if self.create_log_entry:
             self.update_log_entry_finish_query()
 
+    def count_request(self):
+        with self.query_count_lock:
+            self.query_count += 1
+
+    def start_request(self):
+        self.count_request()
+        if self.create_log_entry:
+            self.update_log_entry_start_query()
+
     def run_request(self, content, addl_options={}):
+        self.start_request()
+        return self.post_request(content, addl_options)
+
+    def post_request(self, content, addl_options={}):
         addl_options["content"] = content
         addl_options["token"] = self.connection.get_api_token()
         addl_options["format"] = "json"
         addl_options["returnFormat"] = "json"
         # print(addl_options)
-        self.query_count += 1
-        if self.create_log_entry:
-            self.update_log_entry_start_query()
-        return requests.post(self.connection.api_url.url, addl_options).json()
+        with self.metrics.phase("network"):
+            try:
+                response = self.session.post(
+                    self.connection.api_url.url, addl_options, timeout=self.timeout
+                )
+            except requests.Timeout:
+                raise BatchTooLarge("no response within {} seconds".format(self.timeout))
+        self.metrics.add_http(len(response.request.body or ""), len(response.content))
+        if response.status_code in BATCH_TOO_LARGE_STATUSES:
+            raise BatchTooLarge("HTTP {} {}".format(response.status_code, response.reason))
+        with self.metrics.phase("parse"):
+            return response.json()
         # print(oConnection.api_url.url, addl_options)
         # return {}
 
+    def get_field_types(self):
+        """Returns the django_data_type of every field in the project, with a single query"""
+        qField = FieldMetadata.objects.filter(instrument__project__connection=self.connection)
+        return dict(qField.values_list("unique_name", "django_data_type"))
+
+    def get_converter(self, key):
+        """Picks the function that prepares values of column key for the API, once per column"""
+        if self.field_types is None:
+            self.field_types = self.get_field_types()
+        if self.field_types.get(key) == "DateField":
+            converter = convert_upload_date
+        else:
+            converter = convert_upload_value
+        self.converters[key] = converter
+        return converter
+
     def process_record(self, record):
         out_record = {}
+        converters = self.converters
         for key, val in record.items():
-            # try to look up field type
-            oField = FieldMetadata.objects.filter(
-                instrument__project__connection=self.connection, unique_name=key
-            ).first()
-
-            if val is None or val == "":
-                out_record[key] = ""
-            elif oField and oField.django_data_type == "DateField":
-                try:
-                    date_val = dateparser.parse(val)
-                    out_record[key] = date_val.strftime("%Y-%m-%d")
-                except Exception:
-                    raise Exception("Unable to parser value {} for date field {}".format(val, key))
-            elif isinstance(val, datetime.date):
-                out_record[key] = val.strftime("%Y-%m-%d")
-
-            else:
-                out_record[key] = val
+            converter = converters.get(key) or self.get_converter(key)
+            out_record[key] = converter(key, val)
         return out_record